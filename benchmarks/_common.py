@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+性能测试共用的函数
+
+coco/__init__.py 会导入整个 app, 这里只加载需要测试的模块,
+依赖 requirements 中的 paramiko、pyte 等
+"""
+
+import os
+import sys
+import time
+import types
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_coco():
+    """不执行 coco/__init__.py, 之后可以直接 import coco.utils 等模块"""
+    if 'coco' not in sys.modules:
+        coco = types.ModuleType('coco')
+        coco.__path__ = [os.path.join(BASE_DIR, 'coco')]
+        sys.modules['coco'] = coco
+
+
+def best_of(func, repeat=3):
+    """
+    运行 repeat 次, 返回最快一次的毫秒数和结果
+    """
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = (time.perf_counter() - start) * 1000
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
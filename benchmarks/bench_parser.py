@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+命令解析的性能测试
+
+    python benchmarks/bench_parser.py [-n 2000]
+
+对比两种方式解析同样的命令和输出 (提示符 + 逐个字符输入 ls -l + 10 行输出):
+
+- legacy: 原来的方式, 每条命令新建两个 TtyIOParser, 用 pyte 的 screen.display 渲染
+- stream: 每个 Server 一个 TtyStreamParser, 数据到达时增量写入, 只渲染写过的格子
+"""
+
+import argparse
+
+from _common import load_coco, best_of
+
+load_coco()
+
+from coco.utils import TtyIOParser, TtyStreamParser   # noqa: E402
+
+PROMPT = b'[root@localhost ~]# '
+COMMAND = b'ls -l'
+OUTPUT_LINE = b'-rw-r--r--. 1 root root  1024 Jan  1 00:00 file-{:02d}.log\r\n'
+
+
+class LegacyTtyIOParser(TtyIOParser):
+    """原来的渲染方式, 渲染全部 24x80 个格子"""
+
+    def display(self):
+        return self.screen.display
+
+
+def make_chunks():
+    """模拟 recv 到的数据: 输入阶段的回显, 和回车后的输出"""
+    input_chunks = [PROMPT] + [bytes([c]) for c in COMMAND]
+    output_chunks = [b'\r\n'] + \
+        [OUTPUT_LINE.replace(b'{:02d}', b'%02d' % i) for i in range(10)] + \
+        [PROMPT]
+    return input_chunks, output_chunks
+
+
+def run_legacy(n, input_chunks, output_chunks):
+    result = None
+    for _ in range(n):
+        command = LegacyTtyIOParser().parse_input(input_chunks)
+        output = LegacyTtyIOParser().parse_output(output_chunks)
+        result = (command, output)
+    return result
+
+
+def run_stream(n, input_chunks, output_chunks):
+    parser = TtyStreamParser(maxsize=1024)
+    result = None
+    for _ in range(n):
+        for chunk in input_chunks:
+            parser.feed(chunk)
+        command = parser.parse_input()
+        for chunk in output_chunks:
+            parser.feed(chunk)
+        output = parser.parse_output()
+        result = (command, output)
+    return result
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    arg_parser.add_argument('-n', type=int, default=2000, help='命令数量')
+    args = arg_parser.parse_args()
+
+    input_chunks, output_chunks = make_chunks()
+    legacy_ms, legacy = best_of(
+        lambda: run_legacy(args.n, input_chunks, output_chunks))
+    stream_ms, stream = best_of(
+        lambda: run_stream(args.n, input_chunks, output_chunks))
+    assert legacy == stream, (legacy, stream)
+
+    print("{} commands, command: {!r}, output: {} lines".format(
+        args.n, stream[0], len(stream[1].splitlines())))
+    print("legacy  {:8.1f} ms  {:.3f} ms/command".format(legacy_ms, legacy_ms / args.n))
+    print("stream  {:8.1f} ms  {:.3f} ms/command".format(stream_ms, stream_ms / args.n))
+
+
+if __name__ == '__main__':
+    main()
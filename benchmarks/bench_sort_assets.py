@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+资产排序的性能测试
+
+    python benchmarks/bench_sort_assets.py [-n 50000]
+
+生成 n 个资产 (十分之一是 IPv6), 对比:
+
+- legacy: 原来的 sort_assets, hostname 按字符串排序, ip 按点分割后的数字排序
+- sort_assets: hostname 自然排序, ip 按数值排序, IPv6 也能正确排序
+- AssetIndex: 第一次排序后缓存顺序, 之后的排序 (全部资产和搜索结果)
+"""
+
+import argparse
+import ipaddress
+import random
+import types
+
+from _common import load_coco, best_of
+
+load_coco()
+
+from coco.utils import sort_assets, split_string_int   # noqa: E402
+from coco.search import AssetIndex                      # noqa: E402
+
+WORDS = ['web', 'db', 'cache', 'App', 'prod', 'Test', 'redis', 'mysql', 'nginx']
+
+
+def legacy_sort_assets(assets, order_by='hostname'):
+    if order_by == 'ip':
+        return sorted(assets, key=lambda asset: [int(d) for d in asset.ip.split('.') if d.isdigit()])
+    return sorted(assets, key=lambda asset: getattr(asset, order_by))
+
+
+def legacy_split_string_int(s):
+    string_list = []
+    index = 0
+    pre_type = None
+    word = ''
+    for i in s:
+        if index == 0:
+            pre_type = int if i.isdigit() else str
+            word = i
+        else:
+            if pre_type is int and i.isdigit() or pre_type is str and not i.isdigit():
+                word += i
+            else:
+                string_list.append(word.lower() if not word.isdigit() else int(word))
+                word = i
+                pre_type = int if i.isdigit() else str
+        index += 1
+    string_list.append(word.lower() if not word.isdigit() else int(word))
+    return string_list
+
+
+def make_assets(n):
+    rand = random.Random(7)
+
+    def ip(i):
+        if i % 10 == 0:
+            return str(ipaddress.IPv6Address(rand.getrandbits(128)))
+        return '.'.join(str(rand.randint(0, 255)) for _ in range(4))
+
+    return [types.SimpleNamespace(
+        id=i, ip=ip(i), comment='',
+        hostname='{}-{}-{}-{:02d}'.format(
+            rand.choice(WORDS), rand.choice(WORDS),
+            rand.randint(0, 999), rand.randint(0, 99)),
+    ) for i in range(n)]
+
+
+REPEAT = 5
+
+
+def report(name, ms):
+    print("  {:28s} {:8.1f} ms".format(name, ms))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    arg_parser.add_argument('-n', type=int, default=50000, help='资产数量')
+    args = arg_parser.parse_args()
+
+    assets = make_assets(args.n)
+    subset = assets[::5]
+    print("{} assets".format(args.n))
+    for order_by in ('hostname', 'ip'):
+        print(order_by)
+        report('legacy', best_of(lambda: legacy_sort_assets(assets, order_by), REPEAT)[0])
+        report('sort_assets', best_of(lambda: sort_assets(assets, order_by), REPEAT)[0])
+        index = AssetIndex(assets)
+        report('AssetIndex first sort', best_of(lambda: index.sort(assets, order_by), 1)[0])
+        report('AssetIndex cached', best_of(lambda: index.sort(assets, order_by), REPEAT)[0])
+        report('AssetIndex cached, 1/5 subset', best_of(lambda: index.sort(subset, order_by), REPEAT)[0])
+
+    hostnames = [asset.hostname for asset in assets]
+    print('split_string_int')
+    report('legacy', best_of(lambda: [legacy_split_string_int(h) for h in hostnames], REPEAT)[0])
+    report('split_string_int', best_of(lambda: [split_string_int(h) for h in hostnames], REPEAT)[0])
+
+
+if __name__ == '__main__':
+    main()
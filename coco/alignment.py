@@ -2,24 +2,50 @@
 # -*- coding: utf-8 -*-
 #
 
+import os
+import json
+import glob
 import queue
+import time
+import collections
+
+from .utils import get_logger
+
+logger = get_logger(__file__)
 
 
 class MultiQueueMixin:
     """
-    混合类，增加批量get和批量put方法
+    混合类，增加批量get和批量put方法, 需要和 queue.Queue 一起使用
     """
     def mget(self, size=1, block=True, timeout=5):
         """
         批量get
+
+        等到队列中有 size 个元素或者超过 timeout 秒 (整个批次一共的时间),
+        然后在一次加锁中取出最多 size 个元素
+
+        :param size: 最多取出的个数
+        :param block: 为 False 时不等待, 直接取出当前已有的
+        :param timeout: 最多等待的秒数, None 表示一直等到有 size 个元素
         """
-        items = []
-        for i in range(size):
-            try:
-                items.append(self.get(block=block, timeout=timeout))
-            except queue.Empty:
-                break
-        return items
+        with self.not_empty:
+            if block:
+                deadline = None
+                if timeout is not None:
+                    deadline = time.monotonic() + timeout
+                while self._qsize() < size:
+                    if deadline is None:
+                        self.not_empty.wait()
+                        continue
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.not_empty.wait(remaining)
+            items = [self._get() for _ in range(min(size, self._qsize()))]
+            if items:
+                self.not_full.notify(len(items))
+            return items
 
     def mput(self, data_set):
         """
@@ -28,6 +54,11 @@ class MultiQueueMixin:
         for i in data_set:
             self.put(i)
 
+    def ack(self, size):
+        """
+        确认最早取出的 size 个元素已经处理完, 内存队列不需要做任何事
+        """
+
 
 class MemoryQueue(MultiQueueMixin, queue.Queue):
     """
@@ -36,6 +67,171 @@ class MemoryQueue(MultiQueueMixin, queue.Queue):
     pass
 
 
+class SpillQueue(MultiQueueMixin, queue.Queue):
+    """
+    内存中最多保留 memory_size 个元素, 超出的部分按顺序追加写入本地
+    segment 文件, 内存中的元素取完后再从文件中按顺序读回.
+    put 不会阻塞, 元素需要可以 json 序列化.
+    从 segment 读回的元素 ack 之后才记录 segment 处理到的位置,
+    segment 中的元素都 ack 之后删除文件.
+    启动时会加载同名的 segment 文件, 继续上次没有 ack 的元素 (at-least-once)
+    """
+    segment_size = 10000    # 每个 segment 文件最多的元素数量
+
+    def __init__(self, memory_size, spill_dir, name='queue'):
+        self.memory_size = memory_size
+        self.spill_dir = spill_dir
+        self.name = name
+        super().__init__()
+
+    def _init(self, maxsize):
+        self.memory = collections.deque()       # (元素, 来源)
+        self.taken = collections.deque()        # 已经取出还没有 ack 的元素的来源
+        self.segments = collections.deque()     # [path, 剩余元素数量, 已读取的行数]
+        # 来源是 (segment path, 行号), 不是从 segment 读回的元素来源为 None
+        self._last_line = {}    # segment 中最后一个读回内存的元素的行号
+        self._committed = {}    # segment 中已经 ack 的行号
+        self._drained = {}      # 已经读完, 等待 ack 的 segment: 最后一个元素的行号
+        self.disk_size = 0
+        self._writer = None
+        self._writer_count = 0
+        self._reader = None
+        self._seq = 0
+        os.makedirs(self.spill_dir, exist_ok=True)
+        self._load_segments()
+
+    def _segment_path(self, seq):
+        return os.path.join(self.spill_dir, '{}.{:08d}.seg'.format(self.name, seq))
+
+    @staticmethod
+    def _offset_path(path):
+        return path + '.offset'
+
+    def _load_segments(self):
+        pattern = os.path.join(self.spill_dir, '{}.*.seg'.format(self.name))
+        for path in sorted(glob.glob(pattern)):
+            with open(path) as f:
+                count = sum(1 for _ in f)
+            offset = 0
+            try:
+                with open(self._offset_path(path)) as f:
+                    offset = int(f.read().strip() or 0)
+            except (OSError, ValueError):
+                pass
+            self.segments.append([path, count - offset, offset])
+            self._committed[path] = offset
+            self.disk_size += count - offset
+            self._seq = int(path.rsplit('.', 2)[-2]) + 1
+        if self.disk_size:
+            logger.info("Queue {} load {} items from disk".format(
+                self.name, self.disk_size))
+
+    def _qsize(self):
+        return len(self.memory) + self.disk_size
+
+    def _put(self, item):
+        # 磁盘上有元素时新元素也要写到磁盘, 保证顺序
+        if not self.disk_size and len(self.memory) < self.memory_size:
+            self.memory.append((item, None))
+        else:
+            self._spill(item)
+
+    def _get(self):
+        if not self.memory:
+            self._load()
+        item, source = self.memory.popleft()
+        self.taken.append(source)
+        return item
+
+    def ack(self, size):
+        """
+        确认最早取出的 size 个元素已经处理完, 记录 segment 处理到的位置,
+        重启后从这里继续, 没有 ack 的元素会被重新读回
+        """
+        with self.mutex:
+            lines = {}
+            for _ in range(min(size, len(self.taken))):
+                source = self.taken.popleft()
+                if source is not None:
+                    lines[source[0]] = source[1]
+            for path, line in lines.items():
+                self._commit(path, line)
+
+    def _commit(self, path, line):
+        self._committed[path] = line
+        if self._drained.get(path) == line:
+            del self._drained[path]
+            self._unlink_segment(path)
+            return
+        with open(self._offset_path(path), 'w') as f:
+            f.write(str(line))
+
+    def _spill(self, item):
+        if self._writer is None or self._writer_count >= self.segment_size:
+            if self._writer is not None:
+                self._writer.close()
+            path = self._segment_path(self._seq)
+            self._seq += 1
+            self._writer = open(path, 'a')
+            self._writer_count = 0
+            self.segments.append([path, 0, 0])
+        self._writer.write(json.dumps(item) + '\n')
+        self._writer.flush()
+        self._writer_count += 1
+        self.segments[-1][1] += 1
+        self.disk_size += 1
+
+    def _load(self):
+        """
+        从最早的 segment 读回最多 memory_size 个元素
+        """
+        while len(self.memory) < self.memory_size and self.segments:
+            segment = self.segments[0]
+            if self._reader is None:
+                self._reader = open(segment[0])
+                for _ in range(segment[2]):
+                    self._reader.readline()
+            line = self._reader.readline()
+            if line:
+                segment[1] -= 1
+                segment[2] += 1
+                self.disk_size -= 1
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    logger.error("Queue {} drop bad line in {}".format(
+                        self.name, segment[0]))
+                    continue
+                self.memory.append((item, (segment[0], segment[2])))
+                self._last_line[segment[0]] = segment[2]
+                continue
+            # segment 读完, put 和 get 都在队列的锁中, 这里不会有新写入的元素
+            self._remove_segment()
+
+    def _remove_segment(self):
+        """segment 读完, 所有元素都 ack 之后删除文件"""
+        path, count, _ = self.segments.popleft()
+        self.disk_size -= count
+        self._reader.close()
+        self._reader = None
+        if not self.segments and self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        last = self._last_line.pop(path, None)
+        if last is None or self._committed.get(path, 0) >= last:
+            self._unlink_segment(path)
+        else:
+            self._drained[path] = last
+
+    def _unlink_segment(self, path):
+        self._committed.pop(path, None)
+        for p in (path, self._offset_path(path)):
+            try:
+                os.unlink(p)
+            except OSError:
+                pass
+
+
 def get_queue(config):
     """获取队列"""
     queue_engine = config['QUEUE_ENGINE']
@@ -44,9 +240,29 @@ def get_queue(config):
     if queue_engine == "server":
         replay_queue = MemoryQueue(queue_size)
         command_queue = MemoryQueue(queue_size)
+    elif queue_engine == "spill":
+        replay_queue = get_command_queue(config, 'replay')
+        command_queue = get_command_queue(config, 'command')
     else:
         replay_queue = MemoryQueue(queue_size)
         command_queue = MemoryQueue(queue_size)
 
     return replay_queue, command_queue
 
+
+def get_command_queue(config, name):
+    """
+    获取命令记录使用的队列
+
+    QUEUE_ENGINE 为 spill 时内存中最多保留 QUEUE_MAX_SIZE 个,
+    超出的写入 QUEUE_SPILL_DIR, 否则使用 MemoryQueue
+    """
+    queue_engine = config['QUEUE_ENGINE']
+    queue_size = config['QUEUE_MAX_SIZE']
+
+    if queue_engine == "spill":
+        spill_dir = config['QUEUE_SPILL_DIR'] or \
+            os.path.join(config['LOG_DIR'], 'queue')
+        return SpillQueue(queue_size or 10000, spill_dir, name=name)
+    return MemoryQueue(queue_size)
+
@@ -4,21 +4,33 @@
 
 import datetime
 import os
+import sys
 import time
 import threading
 import socket
 import json
 import signal
+import queue
 
 from jms.service import AppService
 
 from .config import Config
 from .sshd import SSHServer
 from .httpd import HttpServer
+from .bridge import BridgeEngine
+from .parser import ParsePool
+from .pool import TransportPool
+from .cache import TTLCache, RefreshCache
+from .search import AssetList
+from .gateway import GatewayHealth
+from .warmup import ConnectionWarmer
+from .uploader import ReplayUploader
+from .workers import WorkerSupervisor
 from .logger import create_logger
 from .tasks import TaskHandler
 from .recorder import get_command_recorder_class, ServerReplayRecorder
 from .utils import get_logger
+from . import metrics
 
 
 __version__ = '1.2.0'
@@ -46,13 +58,49 @@ class Coco:
         'LOG_DIR': os.path.join(BASE_DIR, 'logs'),
         'SESSION_DIR': os.path.join(BASE_DIR, 'sessions'),
         'ASSET_LIST_SORT_BY': 'hostname',  # hostname, ip
+        'ASSET_COMPLETION': True,   # Opt> 中 Tab 补全 hostname 或 IP, 并显示匹配数量
         'PASSWORD_AUTH': True,
         'PUBLIC_KEY_AUTH': True,
         'HEARTBEAT_INTERVAL': 5,    # 心跳间隔
+        'METRICS_LOG_INTERVAL': 60, # 指标写入日志的间隔, 0 表示不写入
         'MAX_CONNECTIONS': 500,     # 最大链接数
+        'SSHD_WORKERS': 0,          # sshd worker 进程数, 0 或 1 表示单进程
+        'SSHD_HOST_KEY_TYPES': ['rsa'],    # rsa, ecdsa, ed25519, 不存在时生成
+        'SSHD_BACKLOG': 128,        # listen 队列长度
+        'SSHD_HANDSHAKE_WORKERS': 16,       # 同时进行 ssh 握手的线程数
+        'SSHD_HANDSHAKE_QUEUE_SIZE': 256,   # 等待握手的连接数, 超过直接拒绝
         'ADMINS': '',
         'COMMAND_STORAGE': {'TYPE': 'server'},   # server
+        'QUEUE_ENGINE': 'memory',   # memory, spill
+        'QUEUE_MAX_SIZE': 0,        # memory 队列的大小, spill 时内存中保留的数量
+        'QUEUE_SPILL_DIR': '',      # spill 写入的目录, 默认为 LOG_DIR/queue
         'REPLAY_STORAGE': {'TYPE': 'server'},
+        'REPLAY_FLUSH_SIZE': 64 * 1024,     # replay 缓冲多少字节后写入文件
+        'REPLAY_FLUSH_INTERVAL': 1,         # replay 缓冲最多多少秒后写入文件
+        'REPLAY_STREAM_COMPRESS': '',       # '', gzip, zstd, lz4
+        'REPLAY_FORMAT': 'json',            # json, binary
+        'REPLAY_UPLOAD_NATIVE': False,      # zstd、lz4 和 binary 的 replay 不转换为 gzip 直接上传
+        'REPLAY_UPLOAD_WORKERS': 2,         # 同时上传 replay 的数量
+        'REPLAY_UPLOAD_MAX_DELAY': 300,     # 上传失败重试的最大间隔
+        'BRIDGE_ENGINE': 'thread',  # thread, loop
+        'BRIDGE_LOOP_NUM': 0,       # loop 数量, 0 表示 CPU 核数
+        'PARSE_ENGINE': 'sync',     # sync, thread, process
+        'PARSE_WORKER_NUM': 0,      # 解析 worker 数量, 0 表示 CPU 核数
+        'PARSE_QUEUE_SIZE': 1024,   # 每个解析 worker 的队列大小
+        'SSH_POOL': False,              # 复用到资产的 ssh 连接
+        'SSH_POOL_MAX_CHANNELS': 8,     # 每个连接最多同时打开的 channel
+        'SSH_POOL_IDLE_TIMEOUT': 300,   # 没有 channel 的连接保留多少秒
+        'SSH_POOL_CHECK_INTERVAL': 30,  # 连接健康检查的间隔
+        'GATEWAY_MAX_CHANNELS': 64,     # 每个到网关的连接最多同时转发的会话
+        'GATEWAY_RACE_DELAY': 0.3,      # 网关多少秒没有连上时同时尝试下一个
+        'SYSTEM_USER_AUTH_CACHE_TTL': 300,  # 系统用户认证信息缓存多少秒, 0 表示不缓存
+        'SYSTEM_USER_AUTH_CACHE_SIZE': 1000,
+        'ASSET_CACHE_TTL': 0,           # 用户资产和分组缓存多少秒, 0 表示不缓存
+        'ASSET_CACHE_MAX_STALE': 600,   # 过期后多少秒内先返回旧的, 同时在后台刷新
+        'ASSET_CACHE_SIZE': 1000,       # 最多缓存多少个用户
+        'WARMUP': False,            # 登录时预先连接常用资产, 需要启用 SSH_POOL
+        'WARMUP_SIZE': 3,           # 每次登录最多预先连接的资产数
+        'WARMUP_HISTORY_SIZE': 20,  # 每个用户保留的连接记录数
     }
 
     def __init__(self, root_path=None):
@@ -65,9 +113,20 @@ class Coco:
         self._service = None
         self._sshd = None
         self._httpd = None
+        self._bridge_engine = None
+        self._parse_pool = None
+        self._replay_uploader = None
+        self._transport_pool = None
+        self._gateway_pool = None
+        self.gateway_health = GatewayHealth()
+        self._system_user_auth_cache = None
+        self._asset_cache = None
+        self._connection_warmer = None
         self.replay_recorder_class = None
         self.command_recorder_class = None
         self._task_handler = None
+        self.supervisor = None
+        self.worker_id = None
 
     @property
     def name(self):
@@ -94,6 +153,70 @@ class Coco:
             self._httpd = HttpServer(self)
         return self._httpd
 
+    @property
+    def bridge_engine(self):
+        """共享的桥接引擎, 配置为 thread 时为 None"""
+        return self._bridge_engine
+
+    @property
+    def parse_pool(self):
+        """命令解析池, 配置为 sync 时为 None"""
+        return self._parse_pool
+
+    @property
+    def transport_pool(self):
+        """到资产的 ssh 连接池, 没有启用时为 None"""
+        return self._transport_pool
+
+    @property
+    def gateway_pool(self):
+        """到网关的 ssh 连接池, 总是启用"""
+        if self._gateway_pool is None:
+            self._gateway_pool = TransportPool(
+                max_channels=self.config['GATEWAY_MAX_CHANNELS'],
+                idle_timeout=self.config['SSH_POOL_IDLE_TIMEOUT'],
+                check_interval=self.config['SSH_POOL_CHECK_INTERVAL'],
+            )
+        return self._gateway_pool
+
+    @property
+    def system_user_auth_cache(self):
+        """系统用户认证信息的缓存, 只保存在内存中, 没有启用时为 None"""
+        ttl = self.config['SYSTEM_USER_AUTH_CACHE_TTL']
+        if self._system_user_auth_cache is None and ttl:
+            with self.lock:
+                if self._system_user_auth_cache is None:
+                    self._system_user_auth_cache = TTLCache(
+                        maxsize=self.config['SYSTEM_USER_AUTH_CACHE_SIZE'],
+                        ttl=ttl, name='system_user_auth',
+                    )
+        return self._system_user_auth_cache
+
+    @property
+    def asset_cache(self):
+        """用户资产和分组的缓存, ssh、sftp 和 web terminal 共用, 没有启用时为 None"""
+        ttl = self.config['ASSET_CACHE_TTL']
+        if self._asset_cache is None and ttl:
+            with self.lock:
+                if self._asset_cache is None:
+                    self._asset_cache = RefreshCache(
+                        maxsize=self.config['ASSET_CACHE_SIZE'] * 2,
+                        ttl=ttl, max_stale=self.config['ASSET_CACHE_MAX_STALE'],
+                        name='asset_cache',
+                    )
+        return self._asset_cache
+
+    @property
+    def connection_warmer(self):
+        """登录时预先连接常用资产, 没有启用时为 None"""
+        return self._connection_warmer
+
+    @property
+    def replay_uploader(self):
+        if self._replay_uploader is None:
+            self._replay_uploader = ReplayUploader(self)
+        return self._replay_uploader
+
     @property
     def task_handler(self):
         if self._task_handler is None:
@@ -120,6 +243,49 @@ class Coco:
         self.replay_recorder_class = ServerReplayRecorder
         self.command_recorder_class = get_command_recorder_class(self.config)
 
+    def get_user_assets(self, user):
+        """获取用户有权限的资产, 返回的 AssetList 带有搜索索引"""
+        return self.load_user_assets(user)[0]
+
+    def load_user_assets(self, user):
+        """
+        获取用户有权限的资产
+
+        :return: (assets, cached), cached 表示资产列表来自缓存, 没有重新获取
+        """
+        fetched = []
+
+        def fetch():
+            fetched.append(True)
+            return AssetList(self.service.get_user_assets(user) or [])
+
+        if self.asset_cache is None:
+            return fetch(), False
+        assets = self.asset_cache.get(('assets', user.id), fetch)
+        return assets, not fetched
+
+    def get_user_asset_groups(self, user):
+        """获取用户有权限的资产分组"""
+        if self.asset_cache is None:
+            return self.service.get_user_asset_groups(user)
+        return self.asset_cache.get(
+            ('groups', user.id),
+            lambda: self.service.get_user_asset_groups(user))
+
+    def clear_asset_cache(self, user_id=None):
+        """
+        权限变化后清除资产缓存
+
+        :param user_id: 为 None 时清除所有用户的
+        """
+        if self._asset_cache is None:
+            return
+        if user_id is None:
+            self._asset_cache.clear()
+        else:
+            self._asset_cache.pop(('assets', user_id))
+            self._asset_cache.pop(('groups', user_id))
+
     def new_command_recorder(self):
         """创建新的命令记录"""
         recorder = self.command_recorder_class(self)
@@ -135,12 +301,22 @@ class Coco:
         self.service.initial()
         self.load_extra_conf_from_server()
         self.get_recorder_class()
+        if self.config['SSHD_PORT'] == 0 or self.config['SSHD_WORKERS'] <= 1:
+            # 多进程时 ssh 会话都在 worker 中, 由 worker 各自启动,
+            # 主进程中 web terminal 的会话使用线程桥接和同步解析
+            self.run_parse_pool()       # 启动命令解析池
+            self.run_bridge_engine()    # 启动桥接引擎
+        self.run_transport_pool()   # 启动 ssh 连接池
+        self.replay_uploader.start()    # 启动 replay 上传, 继续上传未完成的
         self.keep_heartbeat()   # 保持心跳
         self.monitor_sessions() # 监控器的session
+        self.keep_log_metrics() # 定期记录指标
 
     def heartbeat(self):
         """心跳"""
         _sessions = [s.to_json() for s in self.sessions]
+        if self.supervisor is not None:
+            _sessions.extend(self.supervisor.get_sessions())
         tasks = self.service.terminal_heartbeat(_sessions)
         if tasks:
             self.handle_task(tasks)
@@ -188,6 +364,21 @@ class Coco:
         thread = threading.Thread(target=func)
         thread.start()
 
+    def keep_log_metrics(self):
+        """定期把指标写入日志"""
+        interval = self.config['METRICS_LOG_INTERVAL']
+        if not interval:
+            return
+
+        def func():
+            while not self.stop_evt.wait(interval):
+                logger.info("Metrics: {}".format(
+                    json.dumps(metrics.snapshot(), sort_keys=True)))
+
+        thread = threading.Thread(target=func)
+        thread.daemon = True
+        thread.start()
+
     def run_forever(self):
         self.bootstrap()
         print(time.ctime())
@@ -196,7 +387,10 @@ class Coco:
 
         try:
             if self.config["SSHD_PORT"] != 0:
-                self.run_sshd() # 启动 sshd
+                if self.config['SSHD_WORKERS'] > 1:
+                    self.run_sshd_workers()     # 多进程 sshd
+                else:
+                    self.run_sshd() # 启动 sshd
 
             if self.config['HTTPD_PORT'] != 0:
                 self.run_httpd()
@@ -215,6 +409,96 @@ class Coco:
         thread.daemon = True
         thread.start()
 
+    def run_sshd_workers(self):
+        """启动多个 sshd worker 进程"""
+        self.supervisor = WorkerSupervisor(self, self.config['SSHD_WORKERS'])
+        self.supervisor.start()
+
+    def run_worker(self, worker_id, sock, reports, tasks, connections):
+        """
+        作为 sshd worker 进程运行, 不发送心跳, 定期把 session 报告给主进程
+
+        :param sock: 主进程监听的 socket, 为 None 时用 SO_REUSEPORT 自己绑定
+        :param reports: 报告 session 的队列
+        :param tasks: 接收主进程转交任务的队列
+        :param connections: 所有 worker 共享的连接数数组
+        """
+        self.worker_id = worker_id
+        spill_dir = self.config['QUEUE_SPILL_DIR'] or \
+            os.path.join(self.config['LOG_DIR'], 'queue')
+        self.config['QUEUE_SPILL_DIR'] = os.path.join(
+            spill_dir, 'worker-{}'.format(worker_id))
+        # MAX_CONNECTIONS 是整个服务的限制, 所有 worker 共享连接数
+        self.sshd.worker_connections = connections
+        self.make_logger()
+        self.service.initial()
+        self.get_recorder_class()
+        self.run_parse_pool()
+        self.run_bridge_engine()
+        self.run_transport_pool()
+        self.replay_uploader.start()    # 继续上传这个 worker 未完成的
+        self.monitor_sessions()
+        self.keep_log_metrics()
+
+        def report():
+            interval = self.config["HEARTBEAT_INTERVAL"]
+            while not self.stop_evt.is_set():
+                reports.put((worker_id, [s.to_json() for s in self.sessions]))
+                try:
+                    task = tasks.get(timeout=interval)
+                except queue.Empty:
+                    continue
+                self.handle_task([task])
+
+        thread = threading.Thread(target=report)
+        thread.daemon = True
+        thread.start()
+
+        def on_term(signum, frame):
+            self.shutdown()
+            sys.exit(0)     # 打断阻塞中的 accept
+
+        signal.signal(signal.SIGTERM, on_term)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)    # CONTROL-C 由主进程处理
+        self.sshd.run(sock=sock, reuse_port=sock is None)
+
+    def run_bridge_engine(self):
+        """启动共享的桥接引擎"""
+        if self.config['BRIDGE_ENGINE'] != 'loop':
+            return
+        self._bridge_engine = BridgeEngine(self.config['BRIDGE_LOOP_NUM'])
+        self._bridge_engine.start()
+
+    def run_transport_pool(self):
+        """启动到网关和到资产的 ssh 连接池"""
+        self.gateway_pool.start()
+        if not self.config['SSH_POOL']:
+            return
+        self._transport_pool = TransportPool(
+            max_channels=self.config['SSH_POOL_MAX_CHANNELS'],
+            idle_timeout=self.config['SSH_POOL_IDLE_TIMEOUT'],
+            check_interval=self.config['SSH_POOL_CHECK_INTERVAL'],
+        )
+        self._transport_pool.start()
+        if self.config['WARMUP']:
+            self._connection_warmer = ConnectionWarmer(
+                self,
+                size=self.config['WARMUP_SIZE'],
+                history_size=self.config['WARMUP_HISTORY_SIZE'],
+            )
+            self._connection_warmer.start()
+
+    def run_parse_pool(self):
+        """启动命令解析池"""
+        if self.config['PARSE_ENGINE'] not in ('thread', 'process'):
+            return
+        self._parse_pool = ParsePool(
+            engine=self.config['PARSE_ENGINE'],
+            size=self.config['PARSE_WORKER_NUM'],
+            queue_size=self.config['PARSE_QUEUE_SIZE'],
+        )
+        self._parse_pool.start()
+
     def run_httpd(self):
         """启动 httpd"""
         thread = threading.Thread(target=self.httpd.run, args=())
@@ -225,10 +509,22 @@ class Coco:
         for client in self.clients:
             self.remove_client(client)
         time.sleep(1)
-        self.heartbeat()
+        if self.worker_id is None:
+            self.heartbeat()
         self.stop_evt.set()
+        if self.supervisor is not None:
+            self.supervisor.shutdown()
         self.sshd.shutdown()
         self.httpd.shutdown()
+        if self._bridge_engine is not None:
+            self._bridge_engine.shutdown()
+        if self._parse_pool is not None:
+            self._parse_pool.shutdown()
+        if self._transport_pool is not None:
+            self._transport_pool.shutdown()
+        if self._gateway_pool is not None:
+            self._gateway_pool.shutdown()
+        self.replay_uploader.shutdown()
         logger.info("Grace shutdown the server")
 
     ####################################################################################################
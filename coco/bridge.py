@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+共享的桥接引擎
+
+固定数量的 I/O 循环（默认每个 CPU 一个），每个循环用一个 selector
+复用多个 Session 的 client/server channel，代替每个 Session 自己阻塞在
+bridge() 的循环里.
+循环线程中不做会阻塞的操作: 发送时对端的窗口满了就放入 session 的缓冲区,
+由循环定期重试; session 的收尾工作在 session 自己的 bridge 线程中执行
+"""
+
+import os
+import socket
+import selectors
+import threading
+import collections
+
+from .utils import get_logger
+
+logger = get_logger(__file__)
+SELECT_TIMEOUT = 5
+FLUSH_INTERVAL = 0.01   # 有待发送的数据时, 多久重试一次
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+
+
+def send_nowait(chan, data):
+    """
+    不阻塞地发送, paramiko 的 channel 窗口满时不发送
+
+    :return: 发送的字节数
+    """
+    if hasattr(chan, 'send_ready'):
+        if not chan.send_ready():
+            return 0
+        return chan.send(data)
+    try:
+        return chan.send(data, MSG_DONTWAIT)
+    except BlockingIOError:
+        return 0
+
+
+class BridgeLoop:
+    """
+    一个 I/O 循环，运行在单独的线程中
+
+    selector 只在循环线程里被修改，其他线程通过 call_soon 投递操作，
+    并用 socketpair 唤醒阻塞中的 select
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.sel = selectors.DefaultSelector()
+        self.sessions = set()
+        self.flushing = set()   # 有待发送数据的 session
+        self.stop_evt = threading.Event()
+        self._pending = collections.deque()
+        self._waker_r, self._waker_w = socket.socketpair()
+        self._waker_r.setblocking(False)
+        self._waker_w.setblocking(False)
+        self.sel.register(self._waker_r, selectors.EVENT_READ)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def call_soon(self, func, *args):
+        """投递一个操作到循环线程执行"""
+        self._pending.append((func, args))
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            self._waker_w.send(b'\0')
+        except OSError:
+            # 缓冲区已满说明循环已经会被唤醒
+            pass
+
+    def _drain_waker(self):
+        try:
+            while self._waker_r.recv(1024):
+                pass
+        except OSError:
+            pass
+
+    def _run_pending(self):
+        while self._pending:
+            func, args = self._pending.popleft()
+            try:
+                func(*args)
+            except Exception as e:
+                logger.error("Bridge loop {} run {} error: {}".format(
+                    self.name, func, e))
+
+    def attach(self, session, socks):
+        """把 session 的 socks 注册到该循环"""
+        self.sessions.add(session)
+        for sock in socks:
+            self.register(sock, session)
+
+    def detach(self, session, socks):
+        self.sessions.discard(session)
+        for sock in socks:
+            self.unregister(sock)
+
+    def want_flush(self, session):
+        """session 有发不出去的数据, 只在循环线程中调用"""
+        self.flushing.add(session)
+
+    def _flush(self):
+        for session in list(self.flushing):
+            if session.stop_evt.is_set():
+                self.flushing.discard(session)
+                continue
+            try:
+                done = session.flush()
+            except Exception as e:
+                logger.error("Session {} flush error: {}".format(session, e))
+                session.close()
+                done = True
+            if done:
+                self.flushing.discard(session)
+
+    def register(self, sock, session):
+        self.call_soon(self._register, sock, session)
+
+    def unregister(self, sock):
+        self.call_soon(self._unregister, sock)
+
+    def _register(self, sock, session):
+        try:
+            self.sel.register(sock, selectors.EVENT_READ, session)
+        except (KeyError, ValueError, OSError) as e:
+            logger.warning("Bridge loop {} register {} failed: {}".format(
+                self.name, sock, e))
+
+    def _unregister(self, sock):
+        try:
+            self.sel.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def run(self):
+        logger.info("Bridge loop {} start".format(self.name))
+        while not self.stop_evt.is_set():
+            timeout = FLUSH_INTERVAL if self.flushing else SELECT_TIMEOUT
+            events = self.sel.select(timeout)
+            for key, _ in events:
+                if key.fileobj is self._waker_r:
+                    self._drain_waker()
+                    continue
+                session = key.data
+                # 同一批事件里 session 可能已经被关闭
+                if session.stop_evt.is_set():
+                    continue
+                try:
+                    session.handle_read(key.fileobj)
+                except Exception as e:
+                    logger.error("Session {} bridge error: {}".format(
+                        session, e))
+                    session.close()
+            self._flush()
+            self._run_pending()
+        self.sel.close()
+        logger.info("Bridge loop {} stop".format(self.name))
+
+    def stop(self):
+        self.stop_evt.set()
+        self._wakeup()
+
+
+class BridgeEngine:
+    """
+    桥接引擎，管理一组 BridgeLoop，新的 session 分配到负载最小的循环
+    """
+
+    def __init__(self, size=0):
+        size = size or os.cpu_count() or 1
+        self.loops = [BridgeLoop('bridge-loop-{}'.format(i))
+                      for i in range(size)]
+        self.lock = threading.Lock()
+
+    def start(self):
+        for loop in self.loops:
+            loop.start()
+
+    def register(self, session):
+        """session 加入桥接"""
+        with self.lock:
+            loop = min(self.loops, key=lambda l: len(l.sessions))
+            session.attach_loop(loop)
+        return loop
+
+    def shutdown(self):
+        for loop in self.loops:
+            loop.stop()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+进程内的缓存
+
+```
+cache = TTLCache(maxsize=1000, ttl=300, name='system_user_auth')
+value = cache.get(key)
+if value is None:
+    value = fetch()
+    cache.set(key, value)
+```
+"""
+
+import time
+import threading
+import collections
+
+from .utils import get_logger
+from . import metrics
+
+logger = get_logger(__file__)
+KEY_LOCKS = 64  # RefreshCache 获取时使用的锁的数量
+
+
+class TTLCache:
+    """
+    有过期时间和大小限制的缓存, 超过大小时淘汰最久没有使用的
+
+    :param maxsize: 最多保存的数量
+    :param ttl: 过期时间, 秒
+    :param name: 指标的名字, 统计 <name>.hit, <name>.miss 和 <name>.hit_rate
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, name='cache'):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+    def _record(self, hit):
+        if hit:
+            self.hits += 1
+            metrics.counter(self.name + '.hit').inc()
+        else:
+            self.misses += 1
+            metrics.counter(self.name + '.miss').inc()
+        metrics.gauge(self.name + '.hit_rate').set(self.hit_rate)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] < time.time():
+                del self._data[key]
+                item = None
+            if item is not None:
+                self._data.move_to_end(key)
+            self._record(item is not None)
+        return default if item is None else item[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.time() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RefreshCache(TTLCache):
+    """
+    过期后在 max_stale 秒内仍然返回旧值, 同时在后台重新获取 (stale-while-revalidate),
+    超过 max_stale 或没有缓存时同步获取, 同一个 key 同时只获取一次
+
+    ```
+    cache.get(key, lambda: service.get_user_assets(user))
+    ```
+
+    :param max_stale: 过期后多少秒内返回旧值
+    """
+
+    def __init__(self, maxsize=1024, ttl=60, max_stale=600, name='cache'):
+        super().__init__(maxsize=maxsize, ttl=ttl, name=name)
+        self.max_stale = max_stale
+        # 固定数量的锁, key 按 hash 分配, 不会随 key 的数量增长
+        self._key_locks = [threading.Lock() for _ in range(KEY_LOCKS)]
+        self._refreshing = set()
+
+    def _key_lock(self, key):
+        return self._key_locks[hash(key) % len(self._key_locks)]
+
+    def _lookup(self, key):
+        """返回 (value, 是否过期), 没有或超过 max_stale 时返回 None"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            now = time.time()
+            if expires + self.max_stale < now:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value, expires < now
+
+    def get(self, key, fetch):
+        """
+        :param fetch: 没有缓存时调用 fetch() 获取
+        """
+        item = self._lookup(key)
+        if item is not None:
+            value, stale = item
+            with self._lock:
+                self._record(True)
+            if stale:
+                metrics.counter(self.name + '.stale').inc()
+                self.refresh_async(key, fetch)
+            return value
+        with self._lock:
+            self._record(False)
+        return self.refresh(key, fetch, force=False)
+
+    def refresh(self, key, fetch, force=True):
+        """
+        获取并缓存
+
+        :param force: 为 False 时, 等待期间其他线程已经获取过则直接返回
+        """
+        with self._key_lock(key):
+            if not force:
+                item = self._lookup(key)
+                if item is not None and not item[1]:
+                    return item[0]
+            value = fetch()
+            self.set(key, value)
+            return value
+
+    def refresh_async(self, key, fetch):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def func():
+            try:
+                self.refresh(key, fetch)
+            except Exception as e:
+                logger.error("Refresh {} {} error: {}".format(self.name, key, e))
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        thread = threading.Thread(target=func)
+        thread.daemon = True
+        thread.start()
@@ -8,5 +8,13 @@ ENTER_CHAR_ORDER = [ord(b'\r'), ord(b'\n')]
 UNSUPPORTED_CHAR = {b'\x15': 'Ctrl-U', b'\x0c': 'Ctrl-L', b'\x05': 'Ctrl-E'}
 CLEAR_CHAR = b'\x1b[H\x1b[2J'
 BELL_CHAR = b'\x07'
+TAB_CHAR = b'\t'
+SAVE_CURSOR_CHAR = b'\x1b7'
+RESTORE_CURSOR_CHAR = b'\x1b8'
+CLEAR_LINE_END_CHAR = b'\x1b[K'
+# 分页: n、空格、下箭头、PageDown 下一页; p、上箭头、PageUp 上一页; q、Ctrl-C、Ctrl-D 退出
+PAGE_NEXT_CHAR = [b'n', b'N', b' ', b'\x1b[B', b'\x1bOB', b'\x1b[6~']
+PAGE_PREV_CHAR = [b'p', b'P', b'\x1b[A', b'\x1bOA', b'\x1b[5~']
+PAGE_QUIT_CHAR = [b'q', b'Q', b'\x03', b'\x04']
 NEW_LINE = b'\r\n'
 RZ_PROTOCOL_CHAR = b'**\x18B0900000000a87c\r\x8a\x11'
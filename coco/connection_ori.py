@@ -2,12 +2,12 @@
 #
 
 import weakref
-import os
 import socket
 
 import paramiko
 from paramiko.ssh_exception import SSHException
 
+from .gateway import race
 from .utils import get_logger, get_private_key_fingerprint
 
 logger = get_logger(__file__)
@@ -30,11 +30,14 @@ class SSHConnection_ori:
         ssh = paramiko.SSHClient()
         ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         sock = None
-        self.get_system_user_auth(system_user)
+        cached = self.load_system_user_auth(system_user)
 
         # 如果资产有 domain ，则获取代理的 sock
         if asset.domain:
             sock = self.get_proxy_sock(asset)
+            # 不能绕过网关直接连接资产
+            if sock is None:
+                return None, "Connect gateway failed"
 
         try:
             # ssh 连接
@@ -62,9 +65,14 @@ class SSHConnection_ori:
                 system_user.username, asset.ip, asset.port,
                 password_short, key_fingerprint,
             ))
+            if isinstance(e, (paramiko.AuthenticationException,
+                              paramiko.BadAuthenticationType)):
+                self.invalidate_system_user_auth(system_user)
             return None, str(e)
         except (socket.error, TimeoutError) as e:
             return None, str(e)
+        if not cached:
+            self.cache_system_user_auth(system_user)
         return ssh, None
 
     def get_transport(self, asset, system_user):
@@ -74,7 +82,43 @@ class SSHConnection_ori:
         else:
             return None, msg
 
+    def open_pooled(self, asset, system_user, opener):
+        """
+        在连接池的 transport 上打开 channel, 没有启用连接池时返回 None
+
+        :param opener: opener(transport) 打开 channel 或 sftp
+        """
+        pool = self.app.transport_pool
+        if pool is None:
+            return None
+        return pool.open(
+            (asset.id, system_user.id),
+            lambda: self.get_ssh_client(asset, system_user),
+            opener,
+        )
+
+    def warm_up(self, asset, system_user):
+        """预先建立连接放入连接池"""
+        pool = self.app.transport_pool
+        if pool is None:
+            return
+        pool.warm(
+            (asset.id, system_user.id),
+            lambda: self.get_ssh_client(asset, system_user),
+        )
+
     def get_channel(self, asset, system_user, term="xterm", width=80, height=24):
+        def invoke_shell(transport):
+            # 和 SSHClient.invoke_shell 一样
+            chan = transport.open_session()
+            chan.get_pty(term, width, height)
+            chan.invoke_shell()
+            return chan
+
+        result = self.open_pooled(asset, system_user, invoke_shell)
+        if result is not None:
+            return result
+
         ssh, msg = self.get_ssh_client(asset, system_user)
         if ssh:
             chan = ssh.invoke_shell(term, width=width, height=height)
@@ -86,6 +130,11 @@ class SSHConnection_ori:
         """
         获取 sftp
         """
+        result = self.open_pooled(
+            asset, system_user, paramiko.SFTPClient.from_transport)
+        if result is not None:
+            return result
+
         ssh, msg = self.get_ssh_client(asset, system_user)
         if ssh:
             return ssh.open_sftp(), None
@@ -100,41 +149,100 @@ class SSHConnection_ori:
         system_user.password, system_user.private_key = \
             self.app.service.get_system_user_auth_info(system_user)
 
+    def load_system_user_auth(self, system_user):
+        """
+        先从 app.system_user_auth_cache 中获取认证信息, 没有时调用 get_system_user_auth
+
+        :return: 是否来自缓存
+        """
+        cache = self.app.system_user_auth_cache
+        auth_info = cache.get(system_user.id) if cache is not None else None
+        if auth_info is not None:
+            system_user.password, system_user.private_key = auth_info
+            return True
+        self.get_system_user_auth(system_user)
+        return False
+
+    def cache_system_user_auth(self, system_user):
+        """连接成功后缓存认证信息, 没有密码和秘钥时不缓存"""
+        cache = self.app.system_user_auth_cache
+        if cache is None:
+            return
+        if system_user.password or system_user.private_key:
+            cache.set(system_user.id,
+                      (system_user.password, system_user.private_key))
+
+    def invalidate_system_user_auth(self, system_user):
+        """认证失败, 下次重新获取认证信息"""
+        cache = self.app.system_user_auth_cache
+        if cache is not None:
+            cache.pop(system_user.id)
+
+    def get_gateway_client(self, gateway):
+        """
+        连接网关
+
+        :return: (SSHClient, msg)
+        """
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            ssh.connect(
+                gateway.ip, port=gateway.port, username=gateway.username,
+                password=gateway.password, pkey=gateway.private_key_obj,
+                timeout=TIMEOUT, auth_timeout=TIMEOUT,
+                look_for_keys=False, allow_agent=False,
+            )
+        except (paramiko.AuthenticationException,
+                paramiko.BadAuthenticationType,
+                SSHException, socket.error, TimeoutError) as e:
+            logger.error("Connect gateway {}@{}:{} failed: {}".format(
+                gateway.username, gateway.ip, gateway.port, e))
+            return None, str(e)
+        return ssh, None
+
+    def open_gateway_channel(self, gateway, asset):
+        """
+        在到网关的连接上打开到资产的 direct-tcpip channel,
+        到网关的连接放在网关连接池中, 多个会话共用
+
+        :return: (channel, msg, dial_failed), dial_failed 表示连接网关失败,
+            池中连接上打开 channel 失败不算网关的问题
+        """
+        dial_failed = []
+
+        def dial():
+            client, msg = self.get_gateway_client(gateway)
+            if client is None:
+                dial_failed.append(msg)
+            return client, msg
+
+        chan, msg = self.app.gateway_pool.open(
+            ('gateway', gateway.id), dial,
+            lambda transport: transport.open_channel(
+                'direct-tcpip', (asset.ip, asset.port), ('127.0.0.1', 0),
+                timeout=TIMEOUT,
+            ),
+        )
+        return chan, msg, bool(dial_failed)
+
     def get_proxy_sock(self, asset):
         """
         获取代理 sock
+
+        按健康得分同时尝试多个网关, 使用最先成功的
+
+        :return: 没有 ssh 网关或所有网关都失败时返回 None
         """
-        sock = None
         domain = self.app.service.get_domain_detail_with_gateway(
             asset.domain
         )
         if not domain.has_ssh_gateway():
             return None
-        for i in domain.gateways:
-            gateway = domain.random_ssh_gateway()
-
-            # 代理命令
-            proxy_command = [
-                "ssh", "-o", "StrictHostKeyChecking=no",
-                "-p", str(gateway.port),
-                "{}@{}".format(gateway.username, gateway.ip),
-                "-W", "{}:{}".format(asset.ip, asset.port), "-q",
-            ]
-
-            if gateway.password:    # 网关 password
-                proxy_command.insert(0, "sshpass -p {}".format(gateway.password))
-
-            if gateway.private_key: # 网关私钥
-                gateway.set_key_dir(os.path.join(self.app.root_path, 'keys'))
-                proxy_command.append("-i {}".format(gateway.private_key_file))
-            proxy_command = ' '.join(proxy_command)
-
-            try:
-                sock = paramiko.ProxyCommand(proxy_command)
-                break
-            except (paramiko.AuthenticationException,
-                    paramiko.BadAuthenticationType, SSHException,
-                    TimeoutError) as e:
-                logger.error(e)
-                continue
-        return sock
+        gateways = [g for g in domain.gateways if g.protocol == 'ssh']
+        health = self.app.gateway_health
+        return race(
+            health.sort(gateways),
+            lambda gateway: self.open_gateway_channel(gateway, asset),
+            health, delay=self.app.config['GATEWAY_RACE_DELAY'],
+        )
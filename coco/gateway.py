@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+网关选择
+
+每个网关记录连接耗时和失败率的滑动平均, 按得分从好到坏依次尝试.
+happy eyeballs 的方式: 先连接最好的网关, delay 秒内没有结果或者失败时
+再同时连接下一个, 使用最先成功的连接, 其余成功的连接直接关闭
+"""
+
+import time
+import queue
+import threading
+
+from .utils import get_logger
+from . import metrics
+
+logger = get_logger(__file__)
+FAILURE_PENALTY = 10    # 失败一次相当于多少秒的连接耗时
+
+
+class GatewayHealth:
+    """
+    网关的健康得分, 得分越低越好
+
+    :param alpha: 滑动平均中最近一次结果的权重
+    """
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self.stats = {}     # gateway id: [连接耗时, 失败率]
+        self.lock = threading.Lock()
+
+    def _update(self, gateway, latency, failed):
+        with self.lock:
+            stat = self.stats.get(gateway.id)
+            if stat is None:
+                self.stats[gateway.id] = [latency, float(failed)]
+                return
+            if not failed:
+                stat[0] += self.alpha * (latency - stat[0])
+            stat[1] += self.alpha * (failed - stat[1])
+
+    def success(self, gateway, latency):
+        metrics.summary('gateway.connect_time').observe(latency)
+        self._update(gateway, latency, False)
+
+    def failure(self, gateway):
+        metrics.counter('gateway.failures').inc()
+        self._update(gateway, 0, True)
+
+    def score(self, gateway):
+        # 没有记录的网关得分为 0, 优先尝试
+        latency, failure = self.stats.get(gateway.id, (0, 0))
+        return latency + failure * FAILURE_PENALTY
+
+    def sort(self, gateways):
+        return sorted(gateways, key=self.score)
+
+
+def race(gateways, connect, health, delay=0.3):
+    """
+    按顺序错开 delay 秒连接网关, 返回最先成功的结果
+
+    :param gateways: 排好序的网关
+    :param connect: connect(gateway) 返回 (sock, msg, dial_failed),
+        dial_failed 表示失败发生在连接网关时, 只有这种失败计入网关的健康得分
+    :param health: GatewayHealth, 记录每次连接的结果
+    :return: 所有网关都失败时返回 None
+    """
+    results = queue.Queue()
+    pending = list(gateways)
+
+    def attempt(gateway):
+        start = time.time()
+        try:
+            sock, msg, dial_failed = connect(gateway)
+        except Exception as e:
+            sock, msg, dial_failed = None, str(e), True
+        results.put((gateway, sock, msg, dial_failed, time.time() - start))
+
+    def start_next():
+        gateway = pending.pop(0)
+        thread = threading.Thread(target=attempt, args=(gateway,))
+        thread.daemon = True
+        thread.start()
+
+    def handle(gateway, sock, msg, dial_failed, latency):
+        if sock is None:
+            logger.error("Connect gateway {} failed: {}".format(gateway.ip, msg))
+            if dial_failed:
+                health.failure(gateway)
+        else:
+            health.success(gateway, latency)
+
+    def close_rest(n):
+        # 已经有结果了, 记录其余网关的结果并关闭多余的连接
+        for _ in range(n):
+            gateway, sock, msg, dial_failed, latency = results.get()
+            handle(gateway, sock, msg, dial_failed, latency)
+            if sock is not None:
+                sock.close()
+
+    running = 0
+    if pending:
+        start_next()
+        running += 1
+    while running:
+        try:
+            gateway, sock, msg, dial_failed, latency = results.get(
+                timeout=delay if pending else None)
+        except queue.Empty:
+            start_next()    # 当前的网关太慢, 同时尝试下一个
+            running += 1
+            continue
+        running -= 1
+        handle(gateway, sock, msg, dial_failed, latency)
+        if sock is not None:
+            if running:
+                thread = threading.Thread(target=close_rest, args=(running,))
+                thread.daemon = True
+                thread.start()
+            return sock
+        if pending:
+            start_next()    # 失败后立即尝试下一个
+            running += 1
+    return None
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 #
 
+import copy
 import socket
 import threading
 import weakref
@@ -12,11 +13,14 @@ from jms.models import Asset, AssetGroup
 from . import char
 from .utils import wrap_with_line_feed as wr, wrap_with_title as title, \
     wrap_with_primary as primary, wrap_with_warning as warning, \
-    is_obj_attr_has, is_obj_attr_eq, sort_assets, TtyIOParser, \
+    wrap_with_color as color, \
+    sort_assets, TtyIOParser, \
     ugettext as _, get_logger
 from .proxy import ProxyServer
+from .search import get_asset_index
 
 logger = get_logger(__file__)
+MAX_CANDIDATES = 50     # Tab 补全最多列出的候选
 
 
 class InteractiveServer_ori:
@@ -28,6 +32,7 @@ class InteractiveServer_ori:
         self.client = client
         self.request = client.request
         self.assets = None
+        self.asset_index = None
         self._search_result = None
         self.asset_groups = None
         self.get_user_assets_async()        # 初始化的时候就异步获取用户资产
@@ -46,6 +51,8 @@ class InteractiveServer_ori:
 
     @search_result.setter
     def search_result(self, value):
+        # 先排序再过滤, 索引中缓存的顺序对应的是没有过滤过的资产
+        value = self.sort_search_result(value)
         value = self.filter_system_users(value)
         self._search_result = value
 
@@ -75,12 +82,13 @@ class InteractiveServer_ori:
         )
         self.client.send(banner)
 
-    def get_option(self, prompt='Opt> '):
+    def get_option(self, prompt='Opt> ', complete=False):
         """实现了一个ssh input, 提示用户输入, 获取并返回
 
+        :param complete: Tab 补全 hostname 或 IP, 并在输入后面显示匹配的数量
         :return user input string
         """
-        # Todo: 实现自动hostname或IP补全
+        complete = complete and self.app.config['ASSET_COMPLETION']
         input_data = []
         parser = TtyIOParser()
         self.client.send(wr(prompt, before=1, after=0))
@@ -99,10 +107,19 @@ class InteractiveServer_ori:
                 else:
                     data = char.BELL_CHAR
                 self.client.send(data)
+                if complete:
+                    self.display_match_count(input_data)
+                continue
+
+            if complete and data == char.TAB_CHAR:
+                self.complete_input(input_data, prompt)
                 continue
 
             if data.startswith(b'\x03'):
                 # Ctrl-C
+                if complete:
+                    # 清除输入后面显示的匹配数量
+                    self.client.send(char.CLEAR_LINE_END_CHAR)
                 self.client.send(b'^C\r\nOpt> ')
                 input_data = []
                 continue
@@ -124,6 +141,8 @@ class InteractiveServer_ori:
 
             # If user type ENTER we should get user input
             if data in char.ENTER_CHAR or multi_char_with_enter:
+                if complete:
+                    self.client.send(char.CLEAR_LINE_END_CHAR)
                 self.client.send(wr(b'', after=2))
                 option = parser.parse_input(input_data)
                 del input_data[:]
@@ -131,6 +150,69 @@ class InteractiveServer_ori:
             else:
                 self.client.send(data)
                 input_data.append(data)
+                if complete:
+                    self.display_match_count(input_data)
+
+    @staticmethod
+    def get_input_text(input_data):
+        return b''.join(input_data).decode('utf-8', 'ignore')
+
+    @staticmethod
+    def is_command(text):
+        """输入是否是 dispatch 处理的命令, 而不是查找资产"""
+        if text.startswith('/'):
+            return True
+        if text.startswith('g') and text.lstrip('g').isdigit():
+            return True
+        return text in ['p', 'P', 'g', 'G', 'q', 'Q', 'exit', 'quit', 'h', 'H']
+
+    def display_match_count(self, input_data):
+        """在输入后面显示 hostname 或 IP 以输入开头的资产数量, 不移动光标"""
+        text = self.get_input_text(input_data)
+        if self.asset_index is None or not text or self.is_command(text):
+            self.client.send(char.CLEAR_LINE_END_CHAR)
+            return
+        count = self.asset_index.prefix.count(text)
+        self.client.send(
+            char.SAVE_CURSOR_CHAR + char.CLEAR_LINE_END_CHAR +
+            color(' [{}]'.format(count), color='cyan').encode('utf-8') +
+            char.RESTORE_CURSOR_CHAR
+        )
+
+    def complete_input(self, input_data, prompt):
+        """
+        Tab 补全, 补全到所有候选的公共前缀,
+        不能继续补全时列出候选
+        """
+        text = self.get_input_text(input_data)
+        if self.asset_index is None or not text:
+            self.client.send(char.BELL_CHAR)
+            return
+        prefix = self.asset_index.prefix
+        completed = prefix.complete(text)
+        if completed is None:
+            self.client.send(char.BELL_CHAR)
+            return
+
+        if len(completed) > len(text):
+            rest = completed[len(text):]
+            # 每个字符单独保存, 退格时一次删除一个
+            input_data.extend(c.encode('utf-8') for c in rest)
+            self.client.send(rest.encode('utf-8'))
+            self.display_match_count(input_data)
+            return
+
+        candidates = prefix.candidates(text, limit=MAX_CANDIDATES + 1)
+        if len(candidates) <= 1:
+            self.client.send(char.BELL_CHAR)
+            return
+        lines = '  '.join(candidates[:MAX_CANDIDATES])
+        if len(candidates) > MAX_CANDIDATES:
+            lines += '  ...'
+        self.client.send(char.CLEAR_LINE_END_CHAR)
+        self.client.send(wr(lines, before=1))
+        self.client.send(prompt + text)
+        self.display_match_count(input_data)
 
     def dispatch(self, opt):
         """调度"""
@@ -166,17 +248,15 @@ class InteractiveServer_ori:
 
         # 全匹配到则直接返回全匹配的
         if len(result) == 0:
-            # 遍历asset的属性并判断是否全匹配查找的字段
-            _result = [
-                asset for asset in self.assets if is_obj_attr_eq(asset, q)]
+            # id, hostname, ip 等于查找的字段
+            _result = self.asset_index.get(q)
             if len(_result) == 1:
                 result = _result
 
         # 最后模糊匹配
         if len(result) == 0:
-            # 遍历asset的属性并判断是否模糊配查找的字段
-            result = [
-                asset for asset in self.assets if is_obj_attr_has(asset, q)]
+            # hostname, ip, comment 包含查找的字段
+            result = self.asset_index.search(q)
 
         # 保存结果
         self.search_result = result
@@ -225,17 +305,32 @@ class InteractiveServer_ori:
         self.search_result = self.asset_groups[_id - 1].assets_granted
         self.display_search_result()
 
+    def sort_search_result(self, result):
+        """排序, 用户的资产使用索引中缓存的顺序"""
+        order_by = self.app.config["ASSET_LIST_SORT_BY"]
+        if self.asset_index is not None:
+            ordered = self.asset_index.sort(result, order_by)
+            if ordered is not None:
+                return ordered
+        return sort_assets(result, order_by)
+
+    def get_page_size(self):
+        """每页的行数, 去掉表头、总数和分页提示"""
+        return max(self.request.meta.get("height", 24) - 4, 5)
+
     def display_search_result(self):
-        """显示查找结果"""
-        self.search_result = sort_assets(
-            self.search_result, self.app.config["ASSET_LIST_SORT_BY"])
+        """显示查找结果, 超过一屏时分页, 每页一次发送"""
+        result = self.search_result
         fake_asset = Asset(hostname=_("Hostname"), ip=_("IP"), _system_users_name_list=_("LoginAs"),
                            comment=_("Comment"))
-        id_max_length = max(len(str(len(self.search_result))), 3)
-        hostname_max_length = max(
-            max([len(asset.hostname) for asset in self.search_result + [fake_asset]]), 15)
-        sysuser_max_length = max([len(asset.system_users_name_list)
-                                  for asset in self.search_result + [fake_asset]])
+        id_max_length = max(len(str(len(result))), 3)
+        hostname_max_length = 15
+        sysuser_max_length = len(fake_asset.system_users_name_list)
+        for asset in result:
+            hostname_max_length = max(hostname_max_length, len(asset.hostname))
+            sysuser_max_length = max(
+                sysuser_max_length, len(asset.system_users_name_list))
+        hostname_max_length = max(hostname_max_length, len(fake_asset.hostname))
         header = '{1:>%d} {0.hostname:%d} {0.ip:15} {0.system_users_name_list:%d} ' % \
                  (id_max_length, hostname_max_length, sysuser_max_length)
         comment_length = self.request.meta[
@@ -243,12 +338,48 @@ class InteractiveServer_ori:
         # comment中可能有中文
         line = header + '{0.comment:.%d}' % (comment_length // 2)
         header += '{0.comment:%s}' % comment_length
-        self.client.send(wr(title(header.format(fake_asset, "ID"))))
-        for index, asset in enumerate(self.search_result, 1):
-            self.client.send(wr(line.format(asset, index)))
-        self.client.send(wr(_("总共: {} 匹配: {}").format(
-            len(self.assets), len(self.search_result)), before=1)
-        )
+        header = wr(title(header.format(fake_asset, "ID")))
+        total = wr(_("总共: {} 匹配: {}").format(
+            len(self.assets), len(result)), before=1)
+
+        page_size = self.get_page_size()
+        pages = max((len(result) + page_size - 1) // page_size, 1)
+        page = 0
+        while page is not None:
+            start = page * page_size
+            rows = [wr(line.format(asset, index)) for index, asset in
+                    enumerate(result[start:start + page_size], start + 1)]
+            output = header + ''.join(rows) + total
+            if pages == 1:
+                self.client.send(output)
+                return
+            output = char.CLEAR_CHAR.decode() + output + _(
+                "页: {}/{}, n 下一页, p 上一页, q 退出").format(page + 1, pages)
+            self.client.send(output)
+            page = self.get_page(page, pages)
+        self.client.send(wr(''))
+
+    def get_page(self, page, pages):
+        """
+        读取翻页的按键
+
+        :return: 下一个显示的页, 退出时返回 None
+        """
+        while True:
+            data = self.client.recv(10)
+            if len(data) == 0:
+                return None
+            if data in char.PAGE_NEXT_CHAR or data in char.ENTER_CHAR:
+                if page + 1 < pages:
+                    return page + 1
+                if data in char.ENTER_CHAR:  # 最后一页回车退出
+                    return None
+            elif data in char.PAGE_PREV_CHAR:
+                if page > 0:
+                    return page - 1
+            elif data in char.PAGE_QUIT_CHAR:
+                return None
+            self.client.send(char.BELL_CHAR)
 
     def search_and_display(self, q):
         self.search_assets(q)   # 查找资产
@@ -256,8 +387,7 @@ class InteractiveServer_ori:
 
     def get_user_asset_groups(self):
         """获取用户的资产分组"""
-        self.asset_groups = self.app.service.get_user_asset_groups(
-            self.client.user)
+        self.asset_groups = self.app.get_user_asset_groups(self.client.user)
 
     def get_user_asset_groups_async(self):
         """异步获取用户的资产分组"""
@@ -266,20 +396,35 @@ class InteractiveServer_ori:
 
     @staticmethod
     def filter_system_users(assets):
+        """
+        只保留优先级最高的系统用户
+
+        资产可能来自缓存, 被其他会话共用, 需要过滤时返回修改过的副本
+        """
+        result = []
         for asset in assets:
             system_users_granted = asset.system_users_granted
             high_priority = max(
                 [s.priority for s in system_users_granted]) if system_users_granted else 1
             system_users_cleaned = [
                 s for s in system_users_granted if s.priority == high_priority]
-            asset.system_users_granted = system_users_cleaned
-        return assets
+            if len(system_users_cleaned) != len(system_users_granted):
+                asset = copy.copy(asset)
+                asset.system_users_granted = system_users_cleaned
+            result.append(asset)
+        return result
 
     def get_user_assets(self):
         """获取用户的资产"""
-        self.assets = self.app.service.get_user_assets(self.client.user)
+        assets = self.app.get_user_assets(self.client.user)
+        # 先建立搜索索引, 再设置 self.assets, 避免搜索时还没有索引
+        self.asset_index = get_asset_index(assets)
+        self.assets = assets
         logger.debug("Get user {} assets total: {}".format(
             self.client.user, len(self.assets)))
+        if self.app.connection_warmer is not None:
+            # 用户还在看 banner 时预先连接常用资产
+            self.app.connection_warmer.warm_up(self.client.user, self.assets)
 
     def get_user_assets_async(self):
         """异步获取用户的资产"""
@@ -342,7 +487,7 @@ class InteractiveServer_ori:
         self.display_banner()
         while True:
             try:
-                opt = self.get_option()  # 获取选项
+                opt = self.get_option(complete=True)  # 获取选项
                 rv = self.dispatch(opt)  # 调度
                 if rv is self._sentinel:    # 如果是 _sentinel 则 break
                     break
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+进程内的简单指标统计, 每隔 METRICS_LOG_INTERVAL 秒由 app 把 snapshot() 写入日志
+
+```
+from . import metrics
+
+metrics.counter('ssh_pool.hit').inc()
+metrics.summary('bridge.read_size').observe(4096)
+metrics.snapshot()
+```
+"""
+
+import threading
+
+_lock = threading.Lock()
+_registry = {}
+
+
+class Counter:
+    """计数器，只增不减"""
+
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+    def to_json(self):
+        return self.value
+
+
+class Gauge:
+    """当前值"""
+
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+    def dec(self, n=1):
+        with self._lock:
+            self.value -= n
+
+    def to_json(self):
+        return self.value
+
+
+class Summary:
+    """统计观测值的次数、总和、最小、最大和最近一次的值"""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.last = None
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            self.last = value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    @property
+    def avg(self):
+        return self.sum / self.count if self.count else 0
+
+    def to_json(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "avg": self.avg,
+            "min": self.min,
+            "max": self.max,
+            "last": self.last,
+        }
+
+
+def _get_or_create(cls, name):
+    metric = _registry.get(name)
+    if metric is None:
+        with _lock:
+            metric = _registry.setdefault(name, cls(name))
+    return metric
+
+
+def counter(name):
+    return _get_or_create(Counter, name)
+
+
+def gauge(name):
+    return _get_or_create(Gauge, name)
+
+
+def summary(name):
+    return _get_or_create(Summary, name)
+
+
+def snapshot():
+    """返回所有指标当前的值"""
+    with _lock:
+        metrics = list(_registry.values())
+    return {m.name: m.to_json() for m in metrics}
@@ -34,22 +34,6 @@ class Request:
     #     print("GC: Request object gc")
 
 
-class SizedList(list):
-    def __init__(self, maxsize=0):
-        self.maxsize = maxsize
-        self.size = 0
-        super().__init__()
-
-    def append(self, b):
-        if self.maxsize == 0 or self.size < self.maxsize:
-            super().append(b)
-            self.size += len(b)
-
-    def clean(self):
-        self.size = 0
-        del self[:]
-
-
 class Client:
     """
     Client is the request client. Nothing more to say
@@ -94,6 +78,77 @@ class Client:
     #     print("GC: Client object has been gc")
 
 
+class CommandParser:
+    """
+    从 server 的输入输出中解析出命令和命令的输出
+
+    recv 到的数据调用 feed, send 的数据调用 parse,
+    parse 解析出一条完整的命令时返回 (input, output), 否则返回 None
+    """
+
+    def __init__(self):
+        self._parser = utils.TtyStreamParser(maxsize=1024)
+        self._input_head = None         # 输入状态收到的第一段数据
+        self._in_input_state = True     # 输入状态
+        self._input_initial = False
+        self._input = ""
+        self._output = ""
+
+    def feed(self, data):
+        if self._input_initial:
+            if self._in_input_state and self._input_head is None:
+                self._input_head = data
+            self._parser.feed(data)     # 增量写入 screen
+
+    def parse(self, b):
+        """解析"""
+        if not self._input_initial:
+            self._input_initial = True
+
+        command = None
+        if self._have_enter_char(b):
+            # 已经在输出状态时再次回车, 沿用上一次解析的命令
+            if self._in_input_state:
+                self._input = self._parse_input()   # 解析命令
+            self._in_input_state = False
+        else:
+            if not self._in_input_state:
+                self._output = self._parse_output() # 解析输入
+                logger.debug("\n{}\nInput: {}\nOutput: {}\n{}".format(
+                    "#" * 30 + " Command " + "#" * 30,
+                    self._input, self._output,
+                    "#" * 30 + " End " + "#" * 30,
+                ))
+                if self._input:
+                    command = (self._input, self._output)
+                self._input_head = None
+
+            self._in_input_state = True
+        return command
+
+    @staticmethod
+    def _have_enter_char(s):
+        for c in char.ENTER_CHAR:
+            if c in s:
+                return True
+        return False
+
+    def _parse_output(self):
+        """解析输出"""
+        if not self._parser.size:
+            return ''
+        return self._parser.parse_output()
+
+    def _parse_input(self):
+        """解析输入"""
+        if not self._parser.size:
+            return
+        if self._input_head == char.RZ_PROTOCOL_CHAR:
+            self._parser.reset()
+            return
+        return self._parser.parse_input()
+
+
 class Server:
     """
     Server object like client, a wrapper object, a connection to the asset,
@@ -101,10 +156,12 @@ class Server:
     have the chan and system_user attr.
 
     Server 对象类似于 client ，是一个封装，是一个到资产的连接。
+
+    命令解析默认在桥接线程中同步执行, 传入 parse_pool 时交给解析线程池
     """
 
     # Todo: Server name is not very suitable
-    def __init__(self, chan, asset, system_user):
+    def __init__(self, chan, asset, system_user, parse_pool=None):
         self.chan = chan
         self.asset = asset
         self.system_user = system_user
@@ -112,14 +169,9 @@ class Server:
         self.recv_bytes = 0
         self.stop_evt = threading.Event()
 
-        self.input_data = SizedList(maxsize=1024)
-        self.output_data = SizedList(maxsize=1024)
-        self._in_input_state = True     # 输入状态
-        self._input_initial = False
         self._in_vim_state = False      # vim 模式？
-
-        self._input = ""
-        self._output = ""
+        self._parse_pool = parse_pool
+        self._command_parser = None if parse_pool else CommandParser()
         self._session_ref = None
 
     def fileno(self):
@@ -140,28 +192,12 @@ class Server:
         """解析"""
         if isinstance(b, str):
             b = b.encode("utf-8")
-        if not self._input_initial:
-            self._input_initial = True
-
-        if self._have_enter_char(b):
-            self._in_input_state = False
-            self._input = self._parse_input()   # 解析命令
-        else:
-            if not self._in_input_state:
-                self._output = self._parse_output() # 解析输入
-                logger.debug("\n{}\nInput: {}\nOutput: {}\n{}".format(
-                    "#" * 30 + " Command " + "#" * 30,
-                    self._input, self._output,
-                    "#" * 30 + " End " + "#" * 30,
-                ))
-                if self._input:
-                    self.session.put_command(self._input, self._output) # 存放命令回复历史记录
-                
-                # 清空
-                self.input_data.clean()
-                self.output_data.clean()
-
-            self._in_input_state = True
+        if self._parse_pool is not None:
+            self._parse_pool.parse(self.session, b)
+            return
+        command = self._command_parser.parse(b)
+        if command:
+            self.session.put_command(*command)  # 存放命令回复历史记录
 
     def send(self, b):
         """发送"""
@@ -172,40 +208,23 @@ class Server:
         """接收"""
         data = self.chan.recv(size)
         self.session.put_replay(data)   # 存放命令历史记录
-        if self._input_initial:
-            if self._in_input_state:
-                self.input_data.append(data)
-            else:
-                self.output_data.append(data)
+        if self._parse_pool is not None:
+            self._parse_pool.feed(self.session, data)
+        else:
+            self._command_parser.feed(data)
         return data
 
     def close(self):
         logger.info("Closed server {}".format(self))
-        self.parse(b'')
+        if self._parse_pool is None:
+            self.parse(b'')
+        elif self.session is not None:
+            self._parse_pool.close(self.session)
         self.stop_evt.set()
         self.chan.close()
-        self.chan.transport.close()
-
-    @staticmethod
-    def _have_enter_char(s):
-        for c in char.ENTER_CHAR:
-            if c in s:
-                return True
-        return False
-
-    def _parse_output(self):
-        """解析输出"""
-        if not self.output_data:
-            return ''
-        parser = utils.TtyIOParser()
-        return parser.parse_output(self.output_data)
-
-    def _parse_input(self):
-        """解析输入"""
-        if not self.input_data or self.input_data[0] == char.RZ_PROTOCOL_CHAR:
-            return
-        parser = utils.TtyIOParser()
-        return parser.parse_input(self.input_data)
+        # 连接池中的 transport 由连接池关闭
+        if not getattr(self.chan.transport, 'coco_pooled', False):
+            self.chan.transport.close()
 
     def __getattr__(self, item):
         return getattr(self.chan, item)
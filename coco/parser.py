@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+命令解析池
+
+把命令和命令输出的解析从桥接线程挪到固定数量的 worker 中,
+桥接线程只需要把数据放进队列.
+同一个 session 的数据总是交给同一个 worker, 保证顺序,
+worker 为每个 session 维护一个 CommandParser.
+
+engine 可以是 thread 或 process, process 模式下 worker 是 spawn 出来的子进程,
+和 sshd worker 一样不继承主进程的线程和锁,
+解析结果通过结果队列交回主进程写入命令记录
+"""
+
+import os
+import queue
+import threading
+import multiprocessing
+
+from .models import CommandParser
+from .utils import get_logger
+
+logger = get_logger(__file__)
+
+OP_FEED = 'feed'
+OP_PARSE = 'parse'
+OP_CLOSE = 'close'
+
+
+def parse_worker(tasks, results):
+    """
+    worker 循环, 处理 (op, session_id, data) 任务,
+    结果 (session_id, command, closed) 放入 results
+    """
+    parsers = {}
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        op, session_id, data = task
+        try:
+            parser = parsers.get(session_id)
+            if parser is None:
+                parser = parsers[session_id] = CommandParser()
+            if op == OP_FEED:
+                parser.feed(data)
+                continue
+            command = parser.parse(data)
+            closed = op == OP_CLOSE
+            if closed:
+                del parsers[session_id]
+            if command or closed:
+                results.put((session_id, command, closed))
+        except Exception as e:
+            logger.error("Parse session {} command error: {}".format(
+                session_id, e))
+
+
+class ParsePool:
+    """
+    命令解析池
+
+    :param engine: thread 或 process
+    :param size: worker 数量, 0 表示 CPU 核数
+    :param queue_size: 每个 worker 任务队列的大小, 队列满时桥接线程会等待
+    """
+
+    def __init__(self, engine='thread', size=0, queue_size=1024):
+        self.engine = engine
+        self.size = size or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self._workers = []
+        self._tasks = []
+        if engine == 'process':
+            self._ctx = multiprocessing.get_context('spawn')
+            self._results = self._ctx.Queue()
+        else:
+            self._results = queue.Queue()
+
+    def start(self):
+        for i in range(self.size):
+            if self.engine == 'process':
+                tasks = self._ctx.Queue(self.queue_size)
+                worker = self._ctx.Process(
+                    target=parse_worker, args=(tasks, self._results),
+                    name='parse-worker-{}'.format(i)
+                )
+            else:
+                tasks = queue.Queue(self.queue_size)
+                worker = threading.Thread(
+                    target=parse_worker, args=(tasks, self._results),
+                    name='parse-worker-{}'.format(i)
+                )
+            worker.daemon = True
+            worker.start()
+            self._tasks.append(tasks)
+            self._workers.append(worker)
+
+        thread = threading.Thread(target=self.dispatch_results)
+        thread.daemon = True
+        thread.start()
+
+    def _submit(self, session, op, data):
+        if session.id not in self.sessions:
+            with self.lock:
+                self.sessions[session.id] = session
+        tasks = self._tasks[hash(session.id) % self.size]
+        tasks.put((op, session.id, data))
+
+    def feed(self, session, data):
+        """server 收到的数据"""
+        self._submit(session, OP_FEED, data)
+
+    def parse(self, session, data):
+        """发送给 server 的数据"""
+        self._submit(session, OP_PARSE, data)
+
+    def close(self, session):
+        """session 结束, 解析最后一条命令"""
+        self._submit(session, OP_CLOSE, b'')
+
+    def dispatch_results(self):
+        """把解析出的命令写入对应 session 的命令记录"""
+        while True:
+            result = self._results.get()
+            if result is None:
+                break
+            session_id, command, closed = result
+            if closed:
+                with self.lock:
+                    session = self.sessions.pop(session_id, None)
+            else:
+                session = self.sessions.get(session_id)
+            if session is None or not command:
+                continue
+            try:
+                session.put_command(*command)
+            except Exception as e:
+                logger.error("Put session {} command error: {}".format(
+                    session_id, e))
+
+    def shutdown(self):
+        for tasks in self._tasks:
+            tasks.put(None)
+        self._results.put(None)
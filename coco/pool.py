@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+到资产的 ssh 连接池
+
+每个 (asset, system_user) 保留已经认证的 transport, 新的会话、sftp
+直接在已有的 transport 上打开 channel, 省去 TCP 连接、密钥交换和认证.
+每个 transport 最多同时打开 max_channels 个 channel,
+没有 channel 且空闲超过 idle_timeout 的 transport 会被关闭,
+定期发送 ignore 包检查 transport 是否还活着
+"""
+
+import time
+import threading
+
+from paramiko.ssh_exception import SSHException, ChannelException
+
+from .utils import get_logger
+from . import metrics
+
+logger = get_logger(__file__)
+WARM_WAIT = 10  # 等待预先建立的连接的最长时间
+
+
+class PooledTransport:
+    """池中的一个 transport"""
+
+    def __init__(self, key, client):
+        self.key = key
+        self.client = client        # 保留 SSHClient, transport 属于它
+        self.transport = client.get_transport()
+        self.transport.coco_pooled = True
+        self.channels = []
+        self.pending = 0            # 正在打开的 channel
+        self.last_used = time.time()
+
+    @property
+    def active_channels(self):
+        self.channels = [c for c in self.channels if not c.closed]
+        return len(self.channels) + self.pending
+
+    def is_active(self):
+        return self.transport.is_active()
+
+    def close(self):
+        try:
+            self.client.close()
+        except Exception as e:
+            logger.debug("Close pooled transport {} error: {}".format(
+                self.key, e))
+
+    def __str__(self):
+        return "{}/{}".format(*self.key)
+
+
+class TransportPool:
+    """
+    ssh transport 连接池
+
+    :param max_channels: 每个 transport 最多同时打开的 channel 数
+    :param idle_timeout: 没有 channel 的 transport 保留多少秒
+    :param check_interval: 健康检查的间隔
+    """
+
+    def __init__(self, max_channels=8, idle_timeout=300, check_interval=30):
+        self.max_channels = max_channels
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.transports = {}
+        self.warming = {}           # 正在预先建立的连接, key: Event
+        self.lock = threading.Lock()
+        self.stop_evt = threading.Event()
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name='transport-pool')
+        thread.daemon = True
+        thread.start()
+
+    def _checkout(self, key):
+        """取出一个可用的 transport, 没有时返回 None"""
+        with self.lock:
+            candidates = [t for t in self.transports.get(key, ()) if t.is_active()
+                          and t.active_channels < self.max_channels]
+            if not candidates:
+                return None
+            pooled = min(candidates, key=lambda t: t.active_channels)
+            pooled.pending += 1
+            return pooled
+
+    def _add(self, pooled):
+        with self.lock:
+            pooled.pending += 1
+            self.transports.setdefault(pooled.key, []).append(pooled)
+        self._update_gauge()
+
+    def _remove(self, pooled):
+        """从池中移除, 需要持有 self.lock"""
+        transports = self.transports.get(pooled.key, [])
+        if pooled in transports:
+            transports.remove(pooled)
+        if not transports:
+            self.transports.pop(pooled.key, None)
+
+    def _discard(self, pooled):
+        with self.lock:
+            self._remove(pooled)
+        pooled.close()
+        self._update_gauge()
+
+    def _update_gauge(self):
+        metrics.gauge('ssh_pool.transports').set(
+            sum(len(l) for l in list(self.transports.values())))
+
+    def open(self, key, connect, opener):
+        """
+        在池中的 transport 上打开 channel, 没有可用的 transport 时新建连接
+
+        :param key: (asset id, system user id)
+        :param connect: 建立连接, 返回 (SSHClient, msg)
+        :param opener: opener(transport) 打开 channel 或 sftp
+        :return: (opener 的返回值, msg)
+        """
+        pooled = self._checkout(key)
+        if pooled is None:
+            # 正在预先建立连接时等它完成
+            warming = self.warming.get(key)
+            if warming is not None and warming.wait(WARM_WAIT):
+                pooled = self._checkout(key)
+        if pooled is not None:
+            metrics.counter('ssh_pool.hit').inc()
+            try:
+                return self._open(pooled, opener), None
+            except ChannelException as e:
+                # 对端拒绝打开 channel, transport 本身没有问题
+                return None, str(e)
+            except (SSHException, EOFError, OSError) as e:
+                # transport 已经失效, 丢弃后重新连接
+                logger.warning("Pooled transport {} broken: {}".format(
+                    pooled, e))
+                self._discard(pooled)
+
+        metrics.counter('ssh_pool.miss').inc()
+        client, msg = connect()
+        if client is None:
+            return None, msg
+        pooled = PooledTransport(key, client)
+        self._add(pooled)
+        try:
+            return self._open(pooled, opener), None
+        except ChannelException as e:
+            return None, str(e)
+        except (SSHException, EOFError, OSError) as e:
+            self._discard(pooled)
+            return None, str(e)
+
+    def warm(self, key, connect):
+        """
+        预先建立连接放入池中, 已经有可用的连接时不做任何事
+
+        :param connect: 建立连接, 返回 (SSHClient, msg)
+        """
+        with self.lock:
+            if key in self.warming or any(
+                    t.is_active() for t in self.transports.get(key, ())):
+                return
+            event = self.warming[key] = threading.Event()
+        try:
+            client, msg = connect()
+            if client is None:
+                logger.warning("Warm up {} failed: {}".format(key, msg))
+                return
+            pooled = PooledTransport(key, client)
+            with self.lock:
+                self.transports.setdefault(key, []).append(pooled)
+            self._update_gauge()
+            metrics.counter('ssh_pool.warm').inc()
+        finally:
+            with self.lock:
+                self.warming.pop(key, None)
+            event.set()
+
+    def _open(self, pooled, opener):
+        obj = None
+        try:
+            obj = opener(pooled.transport)
+            return obj
+        finally:
+            with self.lock:
+                pooled.pending -= 1
+                pooled.last_used = time.time()
+                if obj is not None:
+                    # SFTPClient.sock 是它使用的 channel
+                    pooled.channels.append(getattr(obj, 'sock', obj))
+
+    def check(self):
+        """关闭失效和空闲的 transport"""
+        now = time.time()
+        idle = []
+        with self.lock:
+            pooled_list = [t for l in self.transports.values() for t in l]
+            for pooled in pooled_list:
+                if pooled.active_channels:
+                    pooled.last_used = now
+                elif now - pooled.last_used > self.idle_timeout:
+                    # 在锁内移除, 避免同时被取出使用
+                    self._remove(pooled)
+                    idle.append(pooled)
+        for pooled in idle:
+            logger.debug("Pooled transport {} idle timeout".format(pooled))
+            pooled.close()
+        self._update_gauge()
+
+        for pooled in pooled_list:
+            if pooled in idle:
+                continue
+            if not pooled.is_active():
+                logger.info("Pooled transport {} inactive".format(pooled))
+            else:
+                try:
+                    pooled.transport.send_ignore()
+                    continue
+                except (SSHException, EOFError, OSError) as e:
+                    logger.info("Pooled transport {} health check failed: {}"
+                                .format(pooled, e))
+            self._discard(pooled)
+
+    def run(self):
+        while not self.stop_evt.wait(self.check_interval):
+            try:
+                self.check()
+            except Exception as e:
+                logger.error("Check transport pool error: {}".format(e))
+
+    def shutdown(self):
+        self.stop_evt.set()
+        with self.lock:
+            pooled_list = [t for l in self.transports.values() for t in l]
+        for pooled in pooled_list:
+            self._discard(pooled)
@@ -50,6 +50,9 @@ class ProxyServer_ori:
         # 连接失败则返回
         if self.server is None:
             return
+        if self.server.chan and self.app.connection_warmer is not None:
+            self.app.connection_warmer.record(
+                self.client.user, asset, system_user)
 
         # 创建记录
         command_recorder = self.app.new_command_recorder()  # 创建新的命令记录
@@ -60,6 +63,7 @@ class ProxyServer_ori:
             self.client, self.server,
             command_recorder=command_recorder,
             replay_recorder=replay_recorder,
+            engine=self.app.bridge_engine,
         )
         self.app.add_session(session)
         self.watch_win_size_change_async()
@@ -116,7 +120,8 @@ class ProxyServer_ori:
 
         self.connecting = False  # 取消连接中状态
         self.client.send(b'\r\n')
-        return Server(chan, asset, system_user)  # 包装成 Server 并返回
+        # 包装成 Server 并返回
+        return Server(chan, asset, system_user, parse_pool=self.app.parse_pool)
 
     def watch_win_size_change(self):
         while self.client.request.change_size_event.wait():
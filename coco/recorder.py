@@ -3,20 +3,41 @@
 #
 
 import abc
+import io
 import threading
 import time
 import os
 import gzip
 import json
+import queue
 import shutil
+import weakref
 
 import jms_storage
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
 from .utils import get_logger
-from .alignment import MemoryQueue
+from .alignment import get_command_queue
+from .replay import JSONReplayEncoder, BinaryReplayEncoder, binary_to_json
+from . import metrics
 
 logger = get_logger(__file__)
 BUF_SIZE = 1024
+REPLAY_SUFFIX = {
+    'gzip': '.replay.gz',
+    'zstd': '.replay.zst',
+    'lz4': '.replay.lz4',
+}
+BINARY_REPLAY_SUFFIX = '.replay.bin'
 
 
 class Singleton(type):
@@ -33,6 +54,86 @@ class Singleton(type):
             return cls.__instance
 
 
+class BatchSizer:
+    """
+    根据队列积压和上传耗时调整每批上传的数量和等待时间
+
+    积压超过当前批量时批量加倍, 积压很少时减半, 单次上传超过 max_latency 秒
+    时减半; 等待时间跟随上传耗时, 空闲时小批量低延迟, 后端变慢时多攒一些
+    """
+
+    def __init__(self, name, min_size=10, max_size=500,
+                 min_timeout=0.5, max_timeout=5, max_latency=5):
+        self.name = name
+        self.min_size = min_size
+        self.max_size = max_size
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.max_latency = max_latency
+        self.size = min_size
+        self.timeout = min_timeout
+
+    def update(self, backlog, latency=0):
+        """
+        :param backlog: 取出这一批后队列中剩余的数量
+        :param latency: 这一批上传的耗时
+        """
+        if latency > self.max_latency:
+            self.size = max(self.size // 2, self.min_size)
+        elif backlog >= self.size:
+            self.size = min(self.size * 2, self.max_size)
+        elif backlog < self.size // 4:
+            self.size = max(self.size // 2, self.min_size)
+        self.timeout = min(max(latency * 2, self.min_timeout), self.max_timeout)
+
+        metrics.gauge(self.name + '.backlog').set(backlog)
+        metrics.gauge(self.name + '.batch_size').set(self.size)
+        if latency:
+            metrics.summary(self.name + '.push_latency').observe(latency)
+
+
+class ReplayWriter(metaclass=Singleton):
+    """
+    后台写 replay 文件的线程, 所有 ServerReplayRecorder 共用
+
+    recorder 把攒好的一批数据放进队列, 由这里统一编码和写文件,
+    空闲时每隔 interval 秒让已注册的 recorder 把缓冲的数据交过来
+    """
+
+    def __init__(self, interval=1):
+        self.interval = interval
+        self.queue = queue.Queue()
+        self.recorders = weakref.WeakSet()
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def register(self, recorder):
+        self.recorders.add(recorder)
+
+    def unregister(self, recorder):
+        self.recorders.discard(recorder)
+
+    def submit(self, func, *args):
+        self.queue.put((func, args))
+
+    def run(self):
+        last_flush = time.time()
+        while True:
+            try:
+                func, args = self.queue.get(timeout=self.interval)
+                func(*args)
+            except queue.Empty:
+                pass
+            except Exception as e:
+                logger.error("Replay writer error: {}".format(e))
+
+            if time.time() - last_flush >= self.interval:
+                last_flush = time.time()
+                for recorder in list(self.recorders):
+                    recorder.flush(force=False)
+
+
 class ReplayRecorder(metaclass=abc.ABCMeta):
     """
     命令回复记录 - 抽象类
@@ -101,11 +202,35 @@ class ServerReplayRecorder(ReplayRecorder):
     1. 使用 session_start 方法打开一个文件，添加 { 头
     2. 使用 record 方法对该文件增加命令记录，格式： "<timestrap>":"<data>", 
     3. 使用 session_end 方法关闭文件，并写入 "0":""}  
-    
+
+    record 只把数据放进内存缓冲, 超过 REPLAY_FLUSH_SIZE 字节或
+    REPLAY_FLUSH_INTERVAL 秒后交给 ReplayWriter 在后台线程写入文件
+
+    REPLAY_STREAM_COMPRESS 为 gzip/zstd/lz4 时直接写入压缩文件,
+    否则写 .replay 文件, 在 session_end 时再压缩为 .replay.gz
+
+    REPLAY_FORMAT 为 binary 时写入可以 seek 的 .replay.bin 文件, 不压缩,
+    格式见 replay.py
+
+    jumpserver 的播放器只能读取 .replay.gz, zstd、lz4 和 binary 的 replay
+    在上传前转换为 .replay.gz, 本地保留原来的文件,
+    REPLAY_UPLOAD_NATIVE 为 True 时直接上传原来的文件
     """
     def __init__(self, app):
         super().__init__(app)
         self.file = None
+        self.flush_size = app.config['REPLAY_FLUSH_SIZE']
+        self.flush_interval = app.config['REPLAY_FLUSH_INTERVAL']
+        self.writer = ReplayWriter(self.flush_interval)
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.buffer_size = 0
+        self.last_flush = time.time()
+        self.binary = app.config['REPLAY_FORMAT'] == 'binary'
+        self.compress = None if self.binary else self.get_compress()
+        self.upload_native = app.config['REPLAY_UPLOAD_NATIVE']
+        self.encoder = None
+        self.replay_file = None
 
     def record(self, data):
         """
@@ -119,222 +244,342 @@ class ServerReplayRecorder(ReplayRecorder):
         """
         # Todo: <liuzheng712@gmail.com>
         if len(data['data']) > 0:
-            # print(json.dumps(
-            #     data['data'].decode('utf-8', 'replace')))
-            
-            # 写入文件
-            self.file.write(
-                '"' + str(data['timestamp'] - self.starttime) + '":' + json.dumps(
-                    data['data'].decode('utf-8', 'replace')) + ',')
+            with self.lock:
+                self.buffer.append((data['timestamp'], data['data']))
+                self.buffer_size += len(data['data'])
+            if self.buffer_size >= self.flush_size:
+                self.flush()
+
+    def flush(self, force=True):
+        """把缓冲的数据交给 ReplayWriter"""
+        with self.lock:
+            if not self.buffer:
+                return
+            if not force and time.time() - self.last_flush < self.flush_interval:
+                return
+            chunks, self.buffer = self.buffer, []
+            self.buffer_size = 0
+            self.last_flush = time.time()
+        self.writer.submit(self.write, chunks)
+
+    def write(self, chunks):
+        """在 ReplayWriter 线程中编码并写入文件"""
+        self.encoder.write(chunks)
+
+    def close_file(self, done):
+        try:
+            self.encoder.close()    # 写入结尾并关闭文件
+        finally:
+            done.set()
+
+    def get_compress(self):
+        """边写边压缩的方式, 没有安装对应的库时使用 gzip"""
+        compress = self.app.config['REPLAY_STREAM_COMPRESS']
+        if not compress:
+            return None
+        if compress not in REPLAY_SUFFIX:
+            logger.warning("Unknown replay compress {}, use gzip".format(compress))
+            return 'gzip'
+        if compress == 'zstd' and zstandard is None or \
+                compress == 'lz4' and lz4 is None:
+            logger.warning("Replay compress {} not installed, use gzip".format(compress))
+            return 'gzip'
+        return compress
+
+    def open_file(self, path):
+        """打开 replay 文件, 按配置包装压缩流"""
+        if self.compress == 'gzip':
+            return gzip.open(path, 'wt', encoding='utf-8')
+        elif self.compress == 'zstd':
+            writer = zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+            return io.TextIOWrapper(writer, encoding='utf-8')
+        elif self.compress == 'lz4':
+            return lz4.frame.open(path, 'wt', encoding='utf-8')
+        else:
+            return open(path, 'a')
 
     def session_start(self, session_id):
         self.starttime = time.time()
         
         # 打开文件
-        self.file = open(os.path.join(
-            self.app.config['LOG_DIR'], session_id + '.replay'
-        ), 'a')
-        self.file.write('{') # 开头加一个 {
+        if self.binary:
+            self.file = open(os.path.join(
+                self.app.config['LOG_DIR'], session_id + BINARY_REPLAY_SUFFIX
+            ), 'wb')
+            self.encoder = BinaryReplayEncoder(self.file, self.starttime)
+        else:
+            if self.compress:
+                suffix = REPLAY_SUFFIX[self.compress]
+            else:
+                suffix = '.replay'
+            self.file = self.open_file(os.path.join(
+                self.app.config['LOG_DIR'], session_id + suffix
+            ))
+            self.encoder = JSONReplayEncoder(self.file, self.starttime)
+        self.writer.register(self)
 
     def session_end(self, session_id):
-        self.file.write('"0":""}')  # 末尾添加： "0":""} 
-        self.file.close()   # 关闭文件
-        
-        # 保存到文件
-        with open(os.path.join(self.app.config['LOG_DIR'], session_id + '.replay'), 'rb') as f_in, \
-                gzip.open(os.path.join(self.app.config['LOG_DIR'], session_id + '.replay.gz'), 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-        
-        # 上传记录
-        if self.upload_replay(session_id):
-            logger.info("Succeed to push {}'s {}".format(session_id, "record"))
+        self.writer.unregister(self)
+        self.flush()
+        done = threading.Event()
+        self.writer.submit(self.close_file, done)
+        done.wait()
+
+        log_dir = self.app.config['LOG_DIR']
+        if self.binary:
+            self.replay_file = session_id + BINARY_REPLAY_SUFFIX
+            if not self.upload_native:
+                binary_to_json(os.path.join(log_dir, self.replay_file),
+                               os.path.join(log_dir, session_id + '.replay'))
+                self.replay_file = self.gzip_replay(session_id)
+        elif self.compress:
+            self.replay_file = session_id + REPLAY_SUFFIX[self.compress]
+            if self.compress != 'gzip' and not self.upload_native:
+                self.replay_file = self.recompress_replay(session_id)
         else:
-            logger.error("Failed to push {}'s {}".format(session_id, "record"))
+            self.replay_file = self.gzip_replay(session_id)
+
+        # 上传记录
         self.upload_replay(session_id)
 
-    def upload_replay(self, session_id):
-        """上传回复记录"""
-        configs = self.app.service.load_config_from_server()
-        logger.debug("upload_replay print config: {}".format(configs))
-
-        # 客户端存储仓库
-        self.client = jms_storage.init(configs["REPLAY_STORAGE"])
-        if not self.client:
-            self.client = jms_storage.jms(self.app.service)
-
-        if self.push_storage(3, session_id):
-            if self.finish_replay(3, session_id):
-                return True
-            else:
-                return False
+    def gzip_replay(self, session_id):
+        """把 .replay 压缩为 .replay.gz"""
+        log_dir = self.app.config['LOG_DIR']
+        with open(os.path.join(log_dir, session_id + '.replay'), 'rb') as f_in, \
+                gzip.open(os.path.join(log_dir, session_id + '.replay.gz'), 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        return session_id + '.replay.gz'
+
+    def recompress_replay(self, session_id):
+        """把 zstd 或 lz4 压缩的 replay 转换为 .replay.gz"""
+        log_dir = self.app.config['LOG_DIR']
+        path = os.path.join(log_dir, self.replay_file)
+        if self.compress == 'zstd':
+            f_in = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
         else:
-            return False
+            f_in = lz4.frame.open(path, 'rb')
+        with f_in, gzip.open(os.path.join(log_dir, session_id + '.replay.gz'), 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        return session_id + '.replay.gz'
 
-    def push_to_storage(self, session_id):
-        return self.client.upload_file(
-            os.path.join(self.app.config['LOG_DIR'],
-                         session_id + '.replay.gz'),
-            time.strftime('%Y-%m-%d', time.localtime(self.starttime)) + '/' + session_id + '.replay.gz')
-
-    def push_storage(self, times, session_id):
-        """推送到仓库"""
-        if times > 0:
-            if self.push_to_storage(session_id):
-                logger.info(
-                    "success push session: {}'s replay log to storage ".format(session_id))
-                return True
-            else:
-                logger.error(
-                    "failed report session {}'s replay log to storage, try  {} times".format(session_id, times))
-                return self.push_storage(times - 1, session_id)
-        else:
-            logger.error(
-                "failed report session {}'s replay log storage, try to push to local".format(session_id))
-            if self.client.type() == 'jms':
-                return False
-            else:
-                self.client = jms_storage.jms(self.app.service)
-                return self.push_storage(3, session_id)
-
-    def finish_replay(self, times, session_id):
-        """收尾"""
-        if times > 0:
-            if self.app.service.finish_replay(session_id):
-                logger.info(
-                    "success report session {}'s replay log ".format(session_id))
-                return True
-            else:
-                logger.error("failed report session {}'s replay log, try {} times".format(
-                    session_id, times))
-                return self.finish_replay(times - 1, session_id)
-        else:
-            logger.error(
-                "failed report session {}'s replay log".format(session_id))
-            return False
+    def upload_replay(self, session_id):
+        """放入 replay 上传队列"""
+        self.app.replay_uploader.upload(
+            session_id,
+            os.path.join(self.app.config['LOG_DIR'], self.replay_file),
+            time.strftime('%Y-%m-%d', time.localtime(self.starttime)) + '/' + self.replay_file
+        )
 
     # def __del__(self):
     #     print("GC: Server replay recorder has been gc")
     #     del self.file
 
 
-class ServerCommandRecorder(CommandRecorder, metaclass=Singleton):
+class CommandSink(metaclass=abc.ABCMeta):
     """
-    服务命令记录
+    命令记录的存储 - 抽象类
     """
-    batch_size = 10
-    timeout = 5
-    no = 0
+    type = None
+    queue_name = None   # 队列的名字, spill 时是 segment 文件名的前缀, 默认为 type
 
     def __init__(self, app):
-        super().__init__(app)
-        self.queue = MemoryQueue()
-        self.stop_evt = threading.Event()
-        self.push_to_server_async()
-        self.__class__.no += 1          # 计数？
-
-    def record(self, data):
-        if data and data['input']:
-            data['input'] = data['input'][:128]     # 截取 128 个字符
-            data['output'] = data['output'][:1024]  # 截取 1024 个字符
-            data['timestamp'] = int(data['timestamp'])  # 时间戳
-            self.queue.put(data)                    # 存到队列里
+        self.app = app
 
-    def push_to_server_async(self):
-        """异步上传到服务"""
-        def func():
-            while not self.stop_evt.is_set():
-                data_set = self.queue.mget(
-                    self.batch_size, timeout=self.timeout)
-                logger.debug("<Session command recorder {}> queue size: {}".format(
-                    self.no, self.queue.qsize())
-                )
-                if not data_set:
-                    continue
-                logger.debug(
-                    "Send {} commands to server".format(len(data_set)))
-                ok = self.app.service.push_session_command(data_set)    # 调用 sdk 上传
-                if not ok:
-                    self.queue.mput(data_set)
-
-        thread = threading.Thread(target=func)
-        thread.daemon = True
-        thread.start()
+    @abc.abstractmethod
+    def push(self, data_set):
+        """
+        保存一批命令记录
+        :return: True or False
+        """
 
-    def session_start(self, session_id):
-        pass
 
-    def session_end(self, session_id):
-        pass
+class ServerCommandSink(CommandSink):
+    """上传到 jumpserver"""
+    type = 'server'
 
-    # def __del__(self):
-    #     print("GC: Session command storage has been gc")
+    def push(self, data_set):
+        return self.app.service.push_session_command(data_set)    # 调用 sdk 上传
 
 
-class ESCommandRecorder(CommandRecorder, metaclass=Singleton):
-    """ES命令记录"""
-    batch_size = 10
-    timeout = 5
-    no = 0
+class ESCommandSink(CommandSink):
+    """保存到 elasticsearch"""
+    type = 'elasticsearch'
+    queue_name = 'es'   # 沿用以前的名字, 继续上传已经写入磁盘的命令
     default_hosts = ["http://localhost"]
 
     def __init__(self, app):
         super().__init__(app)
-        self.queue = MemoryQueue()
-        self.stop_evt = threading.Event()
-        self.push_to_es_async()
-        self.__class__.no += 1
         self.store = jms_storage.ESStore(
             app.config["COMMAND_STORAGE"].get("HOSTS", self.default_hosts))
         if not self.store.ping():
             raise AssertionError("ESCommand storage init error")
 
-    def record(self, data):
-        if data and data['input']:
-            data['input'] = data['input'][:128]
-            data['output'] = data['output'][:1024]
-            data['timestamp'] = int(data['timestamp'])
-            self.queue.put(data)
-
-    def push_to_es_async(self):
-        def func():
-            while not self.stop_evt.is_set():
-                data_set = self.queue.mget(self.batch_size,
-                                           timeout=self.timeout)
-                logger.debug(
-                    "<Session command recorder {}> queue size: {}".format(
-                        self.no, self.queue.qsize())
-                )
-                if not data_set:
-                    continue
-                logger.debug(
-                    "Send {} commands to server".format(len(data_set)))
-                ok = self.store.bulk_save(data_set)
-                if not ok:
-                    self.queue.mput(data_set)
-
-        thread = threading.Thread(target=func)
+    def push(self, data_set):
+        return self.store.bulk_save(data_set)
+
+
+class FileCommandSink(CommandSink):
+    """以 json 行的格式追加到本地文件, 用于审计"""
+    type = 'file'
+
+    def __init__(self, app):
+        super().__init__(app)
+        path = app.config["COMMAND_STORAGE"].get("FILE") or \
+            os.path.join(app.config['LOG_DIR'], 'command.log')
+        self.file = open(path, 'a')
+
+    def push(self, data_set):
+        try:
+            self.file.write(''.join(
+                json.dumps(data) + '\n' for data in data_set))
+            self.file.flush()
+        except (OSError, ValueError) as e:
+            logger.error("Write command file error: {}".format(e))
+            return False
+        return True
+
+
+COMMAND_SINKS = {
+    sink.type: sink
+    for sink in (ServerCommandSink, ESCommandSink, FileCommandSink)
+}
+
+
+def get_command_storage_types(config):
+    """
+    COMMAND_STORAGE 的 TYPE 可以是一个, 也可以是列表或者逗号分隔的多个,
+    如 "server,elasticsearch,file"
+    """
+    storage_types = config["COMMAND_STORAGE"].get('TYPE') or 'server'
+    if isinstance(storage_types, str):
+        storage_types = storage_types.split(',')
+    valid_types = []
+    for storage_type in storage_types:
+        storage_type = storage_type.strip()
+        if storage_type in COMMAND_SINKS:
+            valid_types.append(storage_type)
+        elif storage_type:
+            logger.error("Unknown command storage: {}".format(storage_type))
+    return valid_types or ['server']
+
+
+class CommandSinkWorker:
+    """
+    一个存储的上传线程, 有自己的队列、批量大小和重试
+    """
+    max_retry_delay = 60    # 失败后最长等待时间
+
+    def __init__(self, app, sink, batch_size, max_batch_size, timeout):
+        self.sink = sink
+        self.queue = get_command_queue(
+            app.config, sink.queue_name or sink.type)
+        self.stop_evt = threading.Event()
+        self.sizer = BatchSizer(
+            'command_recorder.' + sink.type, min_size=batch_size,
+            max_size=max_batch_size, max_timeout=timeout
+        )
+        self.failed = 0
+
+    def start(self):
+        thread = threading.Thread(target=self.run)
         thread.daemon = True
         thread.start()
 
+    def put(self, data):
+        self.queue.put(data)
+
+    def run(self):
+        data_set = None
+        while not self.stop_evt.is_set():
+            # 上一批失败时保留下来重试, 成功前不取新的, 保证命令的顺序
+            if not data_set:
+                data_set = self.queue.mget(
+                    self.sizer.size, timeout=self.sizer.timeout)
+            logger.debug("<Command recorder {}> queue size: {}".format(
+                self.sink.type, self.queue.qsize())
+            )
+            if not data_set:
+                self.sizer.update(self.queue.qsize())
+                continue
+            logger.debug("Send {} commands to {}".format(
+                len(data_set), self.sink.type))
+            start = time.time()
+            try:
+                ok = self.sink.push(data_set)
+            except Exception as e:
+                logger.error("Push commands to {} error: {}".format(
+                    self.sink.type, e))
+                ok = False
+            self.sizer.update(self.queue.qsize(), time.time() - start)
+            if ok:
+                # 上传成功后才 ack, 磁盘上的元素在 ack 前重启会重新上传
+                self.queue.ack(len(data_set))
+                self.failed = 0
+                data_set = None
+                continue
+            # 失败后等待一段时间再重试这一批, 不影响其他存储
+            self.failed += 1
+            self.stop_evt.wait(min(2 ** self.failed, self.max_retry_delay))
+
+
+class PipelineCommandRecorder(CommandRecorder, metaclass=Singleton):
+    """
+    命令记录, 截取一次后分发到 COMMAND_STORAGE 配置的所有存储,
+    每个存储独立批量上传和重试
+    """
+    batch_size = 10         # 最小批量
+    max_batch_size = 500    # 最大批量
+    timeout = 5             # 最长等待时间
+    sink_types = None       # 为 None 时从 COMMAND_STORAGE 读取
+
+    def __init__(self, app):
+        super().__init__(app)
+        self.workers = []
+        for sink_type in self.sink_types or get_command_storage_types(app.config):
+            worker = CommandSinkWorker(
+                app, COMMAND_SINKS[sink_type](app), self.batch_size,
+                self.max_batch_size, self.timeout
+            )
+            worker.start()
+            self.workers.append(worker)
+
+    def record(self, data):
+        if data and data['input']:
+            data['input'] = data['input'][:128]     # 截取 128 个字符
+            data['output'] = data['output'][:1024]  # 截取 1024 个字符
+            data['timestamp'] = int(data['timestamp'])  # 时间戳
+            for worker in self.workers:
+                worker.put(data)                    # 存到每个存储的队列里
+
     def session_start(self, session_id):
         pass
 
     def session_end(self, session_id):
         pass
 
-    # def __del__(self):
-    #     print("GC: ES command storage has been gc".format(self))
+
+class ServerCommandRecorder(PipelineCommandRecorder):
+    """
+    服务命令记录
+    """
+    sink_types = ['server']
+
+
+class ESCommandRecorder(PipelineCommandRecorder):
+    """ES命令记录"""
+    sink_types = ['elasticsearch']
 
 
 def get_command_recorder_class(config):
     """获取命令记录类"""
-    command_storage = config["COMMAND_STORAGE"]
-    storage_type = command_storage.get('TYPE')
+    storage_types = get_command_storage_types(config)
 
-    if storage_type == "elasticsearch":
+    if storage_types == ["elasticsearch"]:
         return ESCommandRecorder
-    else:
+    elif storage_types == ["server"]:
         return ServerCommandRecorder
+    else:
+        return PipelineCommandRecorder
 
 #
 # def get_replay_recorder_class(config):
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+replay 文件格式
+
+json 格式是一个对象, key 是相对会话开始的秒数, value 是那一段输出:
+
+    {"0.12":"...","0.53":"...","0":""}
+
+binary 格式:
+
+    header:  MAGIC(8) + 开始时间 double(8)
+    frame:   相对开始时间的毫秒数 uint32 + 数据长度 uint32 + 原始数据
+    index:   每隔 INDEX_INTERVAL 秒记录一次 (毫秒数 uint64, 帧在文件中的位置 uint64)
+    trailer: index 的位置 uint64 + index 数量 uint32 + INDEX_MAGIC(8)
+
+播放器读取文件末尾的 trailer 和 index, 可以直接 seek 到第 N 分钟,
+没有 trailer (进程崩溃) 时从头顺序读取
+"""
+
+import os
+import json
+import struct
+import bisect
+
+MAGIC = b'COCOREP1'
+INDEX_MAGIC = b'COCOIDX1'
+INDEX_INTERVAL = 60
+HEADER = struct.Struct('>8sd')
+FRAME = struct.Struct('>II')
+INDEX = struct.Struct('>QQ')
+TRAILER = struct.Struct('>QI8s')
+
+
+class JSONReplayEncoder:
+    """json 格式的 replay, 写入文本文件"""
+
+    def __init__(self, file, start_time):
+        self.file = file
+        self.start_time = start_time
+        self.file.write('{')    # 开头加一个 {
+
+    def write(self, chunks):
+        """
+        :param chunks: [(timestamp, data), ...]
+        """
+        self.file.write(''.join(
+            '"' + str(timestamp - self.start_time) + '":' + json.dumps(
+                data.decode('utf-8', 'replace')) + ','
+            for timestamp, data in chunks
+        ))
+
+    def close(self):
+        self.file.write('"0":""}')  # 末尾添加： "0":""}
+        self.file.close()
+
+
+class BinaryReplayEncoder:
+    """binary 格式的 replay, 写入二进制文件"""
+
+    def __init__(self, file, start_time):
+        self.file = file
+        self.start_time = start_time
+        self.index = []
+        self.offset = HEADER.size
+        self.file.write(HEADER.pack(MAGIC, start_time))
+
+    def write(self, chunks):
+        """
+        :param chunks: [(timestamp, data), ...]
+        """
+        buf = []
+        for timestamp, data in chunks:
+            ms = max(int((timestamp - self.start_time) * 1000), 0)
+            if not self.index or \
+                    ms - self.index[-1][0] >= INDEX_INTERVAL * 1000:
+                self.index.append((ms, self.offset))
+            buf.append(FRAME.pack(ms, len(data)))
+            buf.append(data)
+            self.offset += FRAME.size + len(data)
+        self.file.write(b''.join(buf))
+
+    def close(self):
+        self.file.write(b''.join(INDEX.pack(*i) for i in self.index))
+        self.file.write(TRAILER.pack(self.offset, len(self.index), INDEX_MAGIC))
+        self.file.close()
+
+
+class BinaryReplayDecoder:
+    """
+    读取 binary 格式的 replay
+
+    ```
+    with open(path, 'rb') as f:
+        decoder = BinaryReplayDecoder(f)
+        for offset, data in decoder.frames(start=600):
+            ...
+    ```
+    """
+
+    def __init__(self, file):
+        self.file = file
+        magic, self.start_time = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("Not a binary replay file")
+        self.index = []
+        self.end = None
+        self.load_index()
+
+    def load_index(self):
+        self.file.seek(0, os.SEEK_END)
+        size = self.file.tell()
+        if size < HEADER.size + TRAILER.size:
+            return
+        self.file.seek(size - TRAILER.size)
+        index_offset, count, magic = TRAILER.unpack(self.file.read(TRAILER.size))
+        if magic != INDEX_MAGIC:
+            return
+        self.file.seek(index_offset)
+        data = self.file.read(INDEX.size * count)
+        self.index = [INDEX.unpack_from(data, i * INDEX.size)
+                      for i in range(count)]
+        self.end = index_offset
+
+    def seek(self, start=0):
+        """定位到 start 秒之前最近的帧"""
+        i = bisect.bisect_right(self.index, (int(start * 1000), float('inf')))
+        if i > 0:
+            self.file.seek(self.index[i - 1][1])
+        else:
+            self.file.seek(HEADER.size)
+
+    def frames(self, start=0):
+        """
+        从 start 秒开始读取
+
+        :return: 生成 (相对开始的秒数, data)
+        """
+        self.seek(start)
+        start_ms = int(start * 1000)
+        while self.end is None or self.file.tell() < self.end:
+            header = self.file.read(FRAME.size)
+            if len(header) < FRAME.size:
+                break
+            ms, length = FRAME.unpack(header)
+            data = self.file.read(length)
+            if len(data) < length:
+                break
+            if ms >= start_ms:
+                yield ms / 1000, data
+
+
+def json_to_binary(src, dst):
+    """
+    把 json 格式的 replay 转换为 binary 格式
+
+    :param src: json replay 文件路径
+    :param dst: binary replay 文件路径
+    """
+    with open(src) as f:
+        frames = json.load(f)
+    chunks = [(float(offset), data.encode('utf-8'))
+              for offset, data in frames.items() if data]
+    with open(dst, 'wb') as f:
+        encoder = BinaryReplayEncoder(f, 0)
+        encoder.write(chunks)
+        encoder.close()
+
+
+def binary_to_json(src, dst):
+    """
+    把 binary 格式的 replay 转换为 json 格式
+
+    :param src: binary replay 文件路径
+    :param dst: json replay 文件路径
+    """
+    chunks = []
+    with open(src, 'rb') as f:
+        decoder = BinaryReplayDecoder(f)
+        for offset, data in decoder.frames():
+            # 同一毫秒的帧在 json 中是同一个 key, 合并在一起
+            if chunks and chunks[-1][0] == offset:
+                chunks[-1] = (offset, chunks[-1][1] + data)
+            else:
+                chunks.append((offset, data))
+    with open(dst, 'w') as f:
+        encoder = JSONReplayEncoder(f, 0)
+        encoder.write(chunks)
+        encoder.close()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+资产搜索索引
+
+用户的资产加载后建立一次索引:
+精确匹配用 id, hostname, ip 到资产的字典,
+模糊匹配用 hostname, ip, comment 的三字符 (trigram) 倒排索引,
+查询时只检查包含最少的那个 trigram 的资产, 少于三个字符时直接扫描.
+Opt> 的补全用排好序的 hostname 和 ip, 二分查找前缀.
+每种排序方式只对全部资产排序一次, 搜索结果按缓存的顺序排序
+"""
+
+import bisect
+import threading
+
+from .utils import sort_assets
+
+EXACT_ATTRS = ("id", "hostname", "ip")
+FUZZY_ATTRS = ("hostname", "ip", "comment")
+GRAM = 3
+SEP = '\0'
+
+
+PREFIX_ATTRS = ("hostname", "ip")
+MAX_CHAR = chr(0x10ffff)
+
+
+def _grams(text):
+    return {text[i:i + GRAM] for i in range(len(text) - GRAM + 1)}
+
+
+class PrefixIndex:
+    """
+    前缀查找, 排好序的字符串上二分查找
+
+    :param keys: 字符串, 重复的只保留一个
+    """
+
+    def __init__(self, keys):
+        self.keys = sorted(set(k for k in keys if k))
+
+    def _range(self, prefix):
+        lo = bisect.bisect_left(self.keys, prefix)
+        hi = bisect.bisect_left(self.keys, prefix + MAX_CHAR, lo)
+        return lo, hi
+
+    def count(self, prefix):
+        """以 prefix 开头的数量"""
+        lo, hi = self._range(prefix)
+        return hi - lo
+
+    def candidates(self, prefix, limit=None):
+        lo, hi = self._range(prefix)
+        if limit is not None:
+            hi = min(hi, lo + limit)
+        return self.keys[lo:hi]
+
+    def complete(self, prefix):
+        """
+        补全到所有以 prefix 开头的字符串的公共前缀
+
+        :return: 补全后的字符串, 没有匹配时返回 None
+        """
+        lo, hi = self._range(prefix)
+        if lo == hi:
+            return None
+        # 排好序后第一个和最后一个的公共前缀就是所有的公共前缀
+        first, last = self.keys[lo], self.keys[hi - 1]
+        n = len(prefix)
+        while n < len(first) and n < len(last) and first[n] == last[n]:
+            n += 1
+        return first[:n]
+
+
+class AssetIndex:
+    """
+    资产的搜索索引, 返回的结果保持资产原来的顺序
+
+    :param assets: 资产列表
+    """
+
+    def __init__(self, assets):
+        self.assets = list(assets)
+        self.exact = {}
+        self.texts = []
+        self.grams = {}
+        self._prefix = None
+        self._sorted = {}       # order_by: (排好序的资产, {id(asset): 顺序})
+        self._lock = threading.Lock()
+        for i, asset in enumerate(self.assets):
+            for attr in EXACT_ATTRS:
+                value = getattr(asset, attr, None)
+                if value is None:
+                    continue
+                positions = self.exact.setdefault(str(value), [])
+                if not positions or positions[-1] != i:
+                    positions.append(i)
+
+            fields = [str(getattr(asset, attr)) for attr in FUZZY_ATTRS
+                      if getattr(asset, attr, None) is not None]
+            self.texts.append(SEP.join(fields))
+            grams = set()
+            for field in fields:
+                grams |= _grams(field)
+            for gram in grams:
+                self.grams.setdefault(gram, []).append(i)
+
+    def __len__(self):
+        return len(self.assets)
+
+    @property
+    def prefix(self):
+        """hostname 和 ip 的前缀索引, 用于 Opt> 的补全"""
+        if self._prefix is None:
+            self._prefix = PrefixIndex(
+                str(getattr(asset, attr)) for asset in self.assets
+                for attr in PREFIX_ATTRS
+                if getattr(asset, attr, None) is not None
+            )
+        return self._prefix
+
+    def _get_sorted(self, order_by):
+        if order_by not in self._sorted:
+            with self._lock:
+                if order_by not in self._sorted:
+                    assets = sort_assets(self.assets, order_by)
+                    ranks = {id(asset): r for r, asset in enumerate(assets)}
+                    self._sorted[order_by] = (assets, ranks)
+        return self._sorted[order_by]
+
+    def sort(self, assets, order_by='hostname'):
+        """
+        按缓存的顺序排序
+
+        :return: 排好序的新列表, assets 中有不在索引里的资产时返回 None
+        """
+        ordered, ranks = self._get_sorted(order_by)
+        if len(assets) == len(self.assets) and \
+                all(a is b for a, b in zip(assets, self.assets)):
+            return list(ordered)
+        try:
+            return sorted(assets, key=lambda asset: ranks[id(asset)])
+        except KeyError:
+            return None
+
+    def get(self, q):
+        """id, hostname 或 ip 等于 q 的资产"""
+        return [self.assets[i] for i in self.exact.get(q, ())]
+
+    def search(self, q):
+        """hostname, ip 或 comment 包含 q 的资产"""
+        if not q:
+            return list(self.assets)
+        if len(q) < GRAM:
+            return [self.assets[i] for i, text in enumerate(self.texts)
+                    if q in text]
+
+        # 取资产最少的 trigram, 它的资产列表按顺序排列,
+        # 逐个确认比求交集更快
+        smallest = None
+        for gram in _grams(q):
+            positions = self.grams.get(gram)
+            if not positions:
+                return []
+            if smallest is None or len(positions) < len(smallest):
+                smallest = positions
+        texts = self.texts
+        return [self.assets[i] for i in smallest if q in texts[i]]
+
+
+class AssetList(list):
+    """资产列表, 第一次搜索时建立索引, 共用缓存的会话共用同一个索引"""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._index = None
+        self._lock = threading.Lock()
+
+    @property
+    def index(self):
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    self._index = AssetIndex(self)
+        return self._index
+
+
+def get_asset_index(assets):
+    """资产的搜索索引, AssetList 使用它自己的索引"""
+    if isinstance(assets, AssetList):
+        return assets.index
+    return AssetIndex(assets)
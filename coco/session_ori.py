@@ -7,20 +7,54 @@ import datetime
 import selectors
 import time
 
+from .bridge import send_nowait
 from .utils import get_logger
+from . import metrics
 
 BUF_SIZE = 1024
+MAX_BUF_SIZE = 64 * 1024
+MAX_PENDING = 1024 * 1024   # loop 模式下最多缓冲多少待发送的数据, 超过时暂停读取
+CLOSE_FLUSH_TIMEOUT = 5     # 关闭时发送剩余数据的超时时间
 logger = get_logger(__file__)
 
 
+class ReadSize:
+    """
+    自适应的读取大小
+
+    读满了说明对端在持续输出，下次读取加倍；读到的数据不到四分之一则减半，
+    交互输入时保持在 BUF_SIZE
+    """
+
+    def __init__(self, min_size=BUF_SIZE, max_size=MAX_BUF_SIZE):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = min_size
+        self.max_used = min_size
+
+    def update(self, n):
+        size = self.size
+        if n >= size and size < self.max_size:
+            size = min(size * 2, self.max_size)
+        elif n < size // 4 and size > self.min_size:
+            size = max(size // 2, self.min_size)
+        else:
+            return
+        self.size = size
+        self.max_used = max(self.max_used, size)
+        metrics.summary('bridge.read_size').observe(size)
+
+
 class Session_ori:
     """
     Session类
     实现 client 和 server 之间的数据转发功能
-    使用 selectors 模块实现
+    使用 selectors 模块实现, 如果传入了 engine 则注册到共享的桥接引擎中,
+    这时发送不阻塞, 收尾工作在 bridge 线程中执行
     """
 
-    def __init__(self, client, server, command_recorder=None, replay_recorder=None):
+    def __init__(self, client, server, command_recorder=None,
+                 replay_recorder=None, engine=None):
         self.id = str(uuid.uuid4())
         self.client = client  # Master of the session, it's a client sock
         self.server = server  # Server channel
@@ -35,6 +69,39 @@ class Session_ori:
         self._replay_recorder = replay_recorder
         self.server.set_session(self)
         self.date_last_active = datetime.datetime.utcnow()
+        self._engine = engine
+        self._loop = None
+        self._read_sizes = {}
+        self._recv_bytes = 0        # 结束时记录一次, 避免每次 recv 都更新全局指标
+        self._out = {}              # loop 模式下没有发送出去的数据, sock: bytearray
+        self._out_lock = threading.Lock()
+        self._paused = False        # 缓冲的数据太多, 暂停读取
+        self._finished = False
+
+    def _register(self, sock):
+        if self._loop is not None:
+            self._loop.register(sock, self)
+        else:
+            self.sel.register(sock, selectors.EVENT_READ)
+
+    def _unregister(self, sock):
+        if self._loop is not None:
+            self._loop.unregister(sock)
+        else:
+            self.sel.unregister(sock)
+
+    @property
+    def socks(self):
+        return [self.client, self.server] + self._watchers + self._sharers
+
+    def attach_loop(self, loop):
+        """
+        注册到桥接引擎的 loop 中，由 loop 线程调用 handle_read
+        """
+        for sock in self._watchers + self._sharers:
+            self.sel.unregister(sock)
+        self._loop = loop
+        loop.attach(self, self.socks)
 
     def add_watcher(self, watcher, silent=False):
         """
@@ -49,12 +116,12 @@ class Session_ori:
         logger.info("Session add watcher: {} -> {} ".format(self.id, watcher))
         if not silent:
             watcher.send("Welcome to watch session {}\r\n".format(self.id).encode("utf-8"))
-        self.sel.register(watcher, selectors.EVENT_READ)
+        self._register(watcher)
         self._watchers.append(watcher)
 
     def remove_watcher(self, watcher):
         logger.info("Session %s remove watcher %s" % (self.id, watcher))
-        self.sel.unregister(watcher)
+        self._unregister(watcher)
         self._watchers.remove(watcher)
 
     def add_sharer(self, sharer, silent=False):
@@ -71,7 +138,7 @@ class Session_ori:
         if not silent:
             sharer.send("Welcome to join session: {}\r\n"
                         .format(self.id).encode("utf-8"))
-        self.sel.register(sharer, selectors.EVENT_READ)
+        self._register(sharer)
         self._sharers.append(sharer)
 
     def remove_sharer(self, sharer):
@@ -80,7 +147,7 @@ class Session_ori:
         sharer.send("Leave session {} at {}"
                     .format(self.id, datetime.datetime.now())
                     .encode("utf-8"))
-        self.sel.unregister(sharer)
+        self._unregister(sharer)
         self._sharers.remove(sharer)
 
     def set_command_recorder(self, recorder):
@@ -136,6 +203,133 @@ class Session_ori:
             pass
         self.close()
 
+    def _send_nowait(self, sock, data):
+        try:
+            return send_nowait(getattr(sock, 'chan', sock), data)
+        except OSError as e:
+            if sock is self.client or sock is self.server:
+                raise
+            # watcher 或 sharer 出错时丢弃发给它的数据
+            logger.info("Session {} send to {} error: {}".format(
+                self.id, sock, e))
+            return len(data)
+
+    def _send(self, sock, data):
+        """
+        发送给 client、server、watcher 或 sharer
+
+        loop 模式下不阻塞, 发送不出去的放入缓冲区由 loop 重试,
+        缓冲的数据超过 MAX_PENDING 时暂停读取, 直到发送出去一半
+        """
+        if self._loop is None:
+            return sock.send(data)
+        if sock is self.server:
+            self.server.parse(data)     # Server.send 中的命令解析
+        with self._out_lock:
+            buf = self._out.get(sock)
+            if buf is None:
+                n = self._send_nowait(sock, data)
+                if n >= len(data):
+                    return
+                buf = self._out[sock] = bytearray()
+                data = data[n:]
+            buf.extend(data)
+            pending = sum(len(b) for b in self._out.values())
+        self._loop.want_flush(self)
+        if pending > MAX_PENDING and not self._paused:
+            self._paused = True
+            for s in self.socks:
+                self._loop.unregister(s)
+
+    def flush(self):
+        """
+        loop 模式下重试发送缓冲的数据, 由 loop 线程调用
+
+        :return: 全部发送出去时返回 True
+        """
+        with self._out_lock:
+            for sock, buf in list(self._out.items()):
+                while buf:
+                    n = self._send_nowait(sock, bytes(buf[:MAX_BUF_SIZE]))
+                    if not n:
+                        break
+                    del buf[:n]
+                if not buf:
+                    del self._out[sock]
+            pending = sum(len(b) for b in self._out.values())
+        if self._paused and pending <= MAX_PENDING // 2:
+            self._paused = False
+            for sock in self.socks:
+                self._loop.register(sock, self)
+        return not pending
+
+    def _flush_blocking(self):
+        """关闭时发送剩余的数据, 最多等待 CLOSE_FLUSH_TIMEOUT 秒"""
+        with self._out_lock:
+            out, self._out = self._out, {}
+        for sock, buf in out.items():
+            chan = getattr(sock, 'chan', sock)
+            timeout = chan.gettimeout()
+            try:
+                chan.settimeout(CLOSE_FLUSH_TIMEOUT)
+                chan.sendall(bytes(buf))
+            except OSError as e:
+                logger.info("Session {} flush to {} error: {}".format(
+                    self.id, sock, e))
+            finally:
+                try:
+                    chan.settimeout(timeout)
+                except OSError:
+                    pass
+
+    def handle_read(self, sock):
+        """
+        处理一个可读的 sock
+
+        :return: False 表示 session 已经关闭
+        """
+        read_size = self._read_sizes.get(sock)
+        if read_size is None:
+            read_size = self._read_sizes[sock] = ReadSize()
+        data = sock.recv(read_size.size)
+        read_size.update(len(data))
+        self._recv_bytes += len(data)
+        # self.put_replay(data)
+        # server
+        if sock == self.server:
+            if len(data) == 0:  # 如果收到的 data 为0， server 关闭连接
+                msg = "Server close the connection"
+                logger.info(msg)
+                self.close()
+                return False
+
+            self.date_last_active = datetime.datetime.utcnow()
+            # 否则向 client 、watcher 和 sharer 发送数据
+            for watcher in [self.client] + self._watchers + self._sharers:
+                self._send(watcher, data)
+        # client
+        elif sock == self.client:
+            if len(data) == 0:  # 如果收到的 data 为0， client 关闭连接
+                msg = "Client close the connection: {}".format(self.client)
+                logger.info(msg)
+                for watcher in self._watchers + self._sharers:
+                    self._send(watcher, msg.encode("utf-8"))
+                self.close()
+                return False
+            self._send(self.server, data)  # 否则向 server 发送数据
+        # sharer
+        elif sock in self._sharers:
+            if len(data) == 0:
+                logger.info("Sharer {} leave the session {}".format(sock, self.id))
+                self.remove_sharer(sock)
+            self._send(self.server, data)  # sharer 向 server 发送数据
+        # watcher
+        elif sock in self._watchers:
+            if len(data) == 0:
+                logger.info("Watcher {} leave the session {}".format(sock, self.id))
+                self.remove_watcher(sock)
+        return True
+
     def bridge(self):
         """
         Bridge clients with server
@@ -145,6 +339,16 @@ class Session_ori:
         logger.info("Start bridge session: {}".format(self.id))
         self.pre_bridge()   # 做一些命令记录的准备工作
 
+        # 使用桥接引擎，由引擎的 loop 负责转发，这里只等待结束, 然后做收尾工作
+        if self._engine is not None:
+            self._engine.register(self)
+            self.stop_evt.wait()
+            logger.info("Session stop event set: {}".format(self.id))
+            # close 可能在注册到 loop 之前调用, 这里再移除一次
+            self._loop.detach(self, self.socks)
+            self._finish()
+            return
+
         # client 和 server 都注册到 selectors
         self.sel.register(self.client, selectors.EVENT_READ)
         self.sel.register(self.server, selectors.EVENT_READ)
@@ -153,41 +357,8 @@ class Session_ori:
         while not self.stop_evt.is_set():
             events = self.sel.select()
             for sock in [key.fileobj for key, _ in events]:
-                data = sock.recv(BUF_SIZE)
-                # self.put_replay(data)
-                # server
-                if sock == self.server:     
-                    if len(data) == 0:  # 如果收到的 data 为0， server 关闭连接
-                        msg = "Server close the connection"
-                        logger.info(msg)
-                        self.close()
-                        break
-
-                    self.date_last_active = datetime.datetime.utcnow()
-                    # 否则向 client 、watcher 和 sharer 发送数据
-                    for watcher in [self.client] + self._watchers + self._sharers:
-                        watcher.send(data)
-                # client
-                elif sock == self.client:
-                    if len(data) == 0:  # 如果收到的 data 为0， client 关闭连接
-                        msg = "Client close the connection: {}".format(self.client)
-                        logger.info(msg)
-                        for watcher in self._watchers + self._sharers:
-                            watcher.send(msg.encode("utf-8"))
-                        self.close()
-                        break
-                    self.server.send(data)  # 否则向 server 发送数据
-                # sharer
-                elif sock in self._sharers:
-                    if len(data) == 0:
-                        logger.info("Sharer {} leave the session {}".format(sock, self.id))
-                        self.remove_sharer(sock)
-                    self.server.send(data)  # sharer 向 server 发送数据
-                # watcher
-                elif sock in self._watchers:
-                    if len(data) == 0:
-                        self._watchers.remove(sock)
-                        logger.info("Watcher {} leave the session {}".format(sock, self.id))
+                if not self.handle_read(sock):
+                    break
         logger.info("Session stop event set: {}".format(self.id))   # stop日志
 
     def set_size(self, width, height):
@@ -195,9 +366,32 @@ class Session_ori:
         logger.debug("Resize server chan size {}*{}".format(width, height))
         self.server.resize_pty(width=width, height=height)
 
+    def read_size_stats(self):
+        """各个 sock 当前和最大的读取大小"""
+        return {
+            str(sock): {"size": r.size, "max": r.max_used}
+            for sock, r in self._read_sizes.items()
+        }
+
     def close(self):
         logger.info("Close the session: {} ".format(self.id))
         self.stop_evt.set()
+        if self._loop is not None:
+            self._loop.detach(self, self.socks)
+        if self._engine is not None:
+            # 收尾工作可能阻塞, 由等待中的 bridge 线程执行, 不占用 loop 线程
+            return
+        self._finish()
+
+    def _finish(self):
+        if self._finished:
+            return
+        self._finished = True
+        logger.debug("Session {} read size: {}, recv bytes: {}".format(
+            self.id, self.read_size_stats(), self._recv_bytes))
+        metrics.summary('bridge.session_recv_bytes').observe(self._recv_bytes)
+        if self._out:
+            self._flush_blocking()
         self.post_bridge()  # 命令记录的收尾工作
         self.date_end = datetime.datetime.utcnow()  # 设置断开时间
         self.server.close()
@@ -3,6 +3,8 @@
 #
 
 import os
+import time
+import queue
 import socket
 import threading
 import paramiko
@@ -13,9 +15,15 @@ from .interface import SSHInterface
 from .interactive import InteractiveServer
 from .models import Client, Request
 from .sftp import SFTPServer
+from . import metrics
 
 logger = get_logger(__file__)
-BACKLOG = 5
+BACKLOG = 128
+HOST_KEY_CLASSES = {
+    'rsa': paramiko.RSAKey,
+    'ecdsa': paramiko.ECDSAKey,
+    'ed25519': paramiko.Ed25519Key,
+}
 
 
 class SSHServer:
@@ -23,57 +31,205 @@ class SSHServer:
     def __init__(self, app):
         self.app = app
         self.stop_evt = threading.Event()
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.host_key_path = os.path.join(
-            self.app.root_path, 'keys', 'host_rsa_key')
+        self.sock = None
+        self.connections = 0
+        self.lock = threading.Lock()
+        # 多进程时每个 worker 的连接数, 由 supervisor 创建, 所有 worker 共享
+        self.worker_connections = None
+        self.handshakes = queue.Queue(
+            self.app.config['SSHD_HANDSHAKE_QUEUE_SIZE'])
+        self._host_keys = None
+
+    @property
+    def host_key_types(self):
+        types = self.app.config['SSHD_HOST_KEY_TYPES']
+        if isinstance(types, str):
+            types = types.split(',')
+        return [t.strip().lower() for t in types if t.strip()]
+
+    def host_key_path(self, key_type):
+        return os.path.join(
+            self.app.root_path, 'keys', 'host_{}_key'.format(key_type))
+
+    @property
+    def host_keys(self):
+        """host key 只在第一次使用时读取, 之后所有连接共用"""
+        if self._host_keys is None:
+            with self.lock:
+                if self._host_keys is None:
+                    self._host_keys = self.load_host_keys()
+        return self._host_keys
 
     @property
     def host_key(self):
-        if not os.path.isfile(self.host_key_path):
-            self.gen_host_key()
-        return paramiko.RSAKey(filename=self.host_key_path)
+        return self.host_keys[0]
 
     ##########################################################################
 
-    def gen_host_key(self):
-        ssh_key, _ = ssh_key_gen()
-        with open(self.host_key_path, 'w') as f:
+    def load_host_keys(self):
+        """读取配置的每种 host key, 不存在时生成"""
+        keys = []
+        for key_type in self.host_key_types:
+            key_class = HOST_KEY_CLASSES.get(key_type)
+            if key_class is None:
+                logger.error("Unknown host key type: {}".format(key_type))
+                continue
+            path = self.host_key_path(key_type)
+            try:
+                if not os.path.isfile(path):
+                    self.gen_host_key(key_type)
+                keys.append(key_class(filename=path))
+            except Exception as e:
+                logger.error("Load {} host key error: {}".format(key_type, e))
+        if not keys:
+            raise ValueError("No valid host key")
+        logger.info("Load host keys: {}".format(
+            ', '.join(key.get_name() for key in keys)))
+        return keys
+
+    def gen_host_key(self, key_type='rsa'):
+        ssh_key, _ = ssh_key_gen(type=key_type)
+        with open(self.host_key_path(key_type), 'w') as f:
             f.write(ssh_key)
 
-    def run(self):
-        """启动 sshd"""
+    @staticmethod
+    def load_moduli():
+        """moduli 保存在 Transport 类上, 每个进程读取一次即可"""
+        try:
+            loaded = paramiko.Transport.load_server_moduli()
+        except IOError:
+            loaded = False
+        if not loaded:
+            logger.warning("Failed load moduli -- gex will be unsupported")
+
+    @staticmethod
+    def make_socket(host, port, reuse_port=False, backlog=BACKLOG):
+        """
+        创建监听的 socket
+
+        :param reuse_port: 设置 SO_REUSEPORT, 多个进程各自绑定同一个端口
+        :param backlog: listen 队列长度
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((host, port))    # 绑定端口
+        sock.listen(backlog)       # 监听
+        return sock
+
+    def run(self, sock=None, reuse_port=False):
+        """
+        启动 sshd
+
+        :param sock: 已经在监听的 socket, 多进程模式下由父进程传入
+        :param reuse_port: 自己绑定端口时设置 SO_REUSEPORT
+        """
         host = self.app.config["BIND_HOST"]
         port = self.app.config["SSHD_PORT"]
         print('Starting ssh server at {}:{}'.format(host, port))
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.bind((host, port))    # 绑定端口
-        self.sock.listen(BACKLOG)       # 监听
+        if sock is None:
+            sock = self.make_socket(host, port, reuse_port=reuse_port,
+                                    backlog=self.app.config['SSHD_BACKLOG'])
+        self.sock = sock
+        self.host_keys
+        self.load_moduli()
+        self.start_handshake_workers()
 
-        # 循环运行
+        # 循环运行, 只负责 accept 和准入, 握手交给 handshake worker
         while not self.stop_evt.is_set():
             try:
                 sock, addr = self.sock.accept()  # accept
                 logger.info(
                     "Get ssh request from {}: {}".format(addr[0], addr[1]))
-                # 使用线程处理连接
-                thread = threading.Thread(
-                    target=self.handle_connection, args=(sock, addr))
-                thread.daemon = True
-                thread.start()
+                self.admit(sock, addr)
             except Exception as e:
                 logger.error("Start SSH server error: {}".format(e))
 
-    def handle_connection(self, sock, addr):
-        """处理连接"""
+    def start_handshake_workers(self):
+        for i in range(self.app.config['SSHD_HANDSHAKE_WORKERS']):
+            thread = threading.Thread(target=self.handshake_worker,
+                                      name='sshd-handshake-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+
+    def admit(self, sock, addr):
+        """准入控制, 超过 MAX_CONNECTIONS 或握手队列已满时直接关闭连接"""
+        if self.acquire():
+            reason = None
+        else:
+            reason = 'max connections {} reached'.format(
+                self.app.config['MAX_CONNECTIONS'])
+        if reason is None:
+            try:
+                self.handshakes.put_nowait((sock, addr, time.time()))
+                metrics.gauge('sshd.connections').set(self.connections)
+                return
+            except queue.Full:
+                self.release()
+                reason = 'handshake queue full'
+        logger.warning("Reject ssh request from {}: {}".format(addr[0], reason))
+        metrics.counter('sshd.rejected').inc()
+        sock.close()
+
+    def acquire(self):
+        """
+        占用一个连接, 多进程时 MAX_CONNECTIONS 是所有 worker 加起来的限制
+
+        :return: 超过 MAX_CONNECTIONS 时返回 False
+        """
+        limit = self.app.config['MAX_CONNECTIONS']
+        with self.lock:
+            if self.worker_connections is None:
+                if self.connections >= limit:
+                    return False
+                self.connections += 1
+                return True
+            with self.worker_connections.get_lock():
+                if sum(self.worker_connections.get_obj()) >= limit:
+                    return False
+                self.connections += 1
+                self.worker_connections[self.app.worker_id] = self.connections
+                return True
+
+    def release(self):
+        """连接结束"""
+        with self.lock:
+            self.connections -= 1
+            if self.worker_connections is not None:
+                self.worker_connections[self.app.worker_id] = self.connections
+        metrics.gauge('sshd.connections').set(self.connections)
+
+    def handshake_worker(self):
+        while not self.stop_evt.is_set():
+            sock, addr, accept_time = self.handshakes.get()
+            metrics.summary('sshd.handshake_wait').observe(
+                time.time() - accept_time)
+            try:
+                conn = self.handshake(sock, addr)
+            except Exception as e:
+                logger.error("SSH handshake error: {}".format(e))
+                conn = None
+            if conn is None:
+                sock.close()
+                self.release()
+                continue
+            # 握手完成后由单独的线程处理连接, worker 继续处理下一个握手
+            thread = threading.Thread(
+                target=self.handle_connection, args=(sock,) + conn)
+            thread.daemon = True
+            thread.start()
 
+    def handshake(self, sock, addr):
+        """
+        ssh 协商
+
+        :return: (transport, server, request), 协商失败返回 None
+        """
         # ssh transport 绑定一个 socket
         transport = paramiko.Transport(sock, gss_kex=False)
-        try:
-            transport.load_server_moduli()
-        except IOError:
-            logger.warning("Failed load moduli -- gex will be unsupported")
-
-        transport.add_server_key(self.host_key)
+        for key in self.host_keys:
+            transport.add_server_key(key)
         transport.set_subsystem_handler(
             'sftp', paramiko.SFTPServer, SFTPServer
         )
@@ -86,11 +242,25 @@ class SSHServer:
             transport.start_server(server=server)   # 启动 ssh server
         except paramiko.SSHException:
             logger.warning("SSH negotiation failed")    # ssh 协商失败
-            return
+            transport.close()
+            return None
         except EOFError:
             logger.warning("Handle EOF Error")
-            return
+            transport.close()
+            return None
+        except Exception:
+            transport.close()
+            raise
+        return transport, server, request
 
+    def handle_connection(self, sock, transport, server, request):
+        """处理连接"""
+        try:
+            self.serve_transport(sock, transport, server, request)
+        finally:
+            self.release()
+
+    def serve_transport(self, sock, transport, server, request):
         # 进入循环
         while True:
             # 如果没有活动的连接，则关闭并break
@@ -107,6 +277,9 @@ class SSHServer:
 
             if not server.event.is_set():
                 logger.warning("Client not request a valid request, exiting")
+                # 先关闭连接, 再释放 MAX_CONNECTIONS 的名额
+                transport.close()
+                sock.close()
                 return
 
             # 线程方式处理 chan，chan和request作为参数
@@ -31,10 +31,29 @@ class TaskHandler:
 
         if session:
             session.terminate()
+        elif self.app.supervisor is not None and \
+                self.app.supervisor.dispatch_task(task):
+            # session 在 worker 进程中, 由 worker 完成任务
+            return
+        self.app.service.finish_task(task.id)
+
+    def handle_clear_asset_cache(self, task):
+        """
+        用户权限变化, 清除资产缓存, task.args 为用户 id, 为空时清除所有用户的
+        """
+        logger.info("Handle clear asset cache task: {}".format(task.args))
+        self.app.clear_asset_cache(task.args or None)
+        if self.app.worker_id is not None:
+            # 主进程转交给每个 worker 的, 由主进程完成任务
+            return
+        if self.app.supervisor is not None:
+            self.app.supervisor.broadcast_task(task)
         self.app.service.finish_task(task.id)
 
     def handle(self, task):
         if task.name == "kill_session":
             self.handle_kill_session(task)
+        elif task.name == "clear_asset_cache":
+            self.handle_clear_asset_cache(task)
         else:
             logger.error("No handler for this task: {}".format(task.name))
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+replay 上传
+
+会话结束后 replay 文件放入上传队列, 由固定数量的 worker 上传,
+失败后按指数退避重试. 每个待上传的文件在 LOG_DIR 下有一个
+<session_id>.upload 标记文件, 上传并通知 server 成功后删除,
+启动时扫描这些标记文件, 继续上传崩溃前没有完成的 replay.
+sshd worker 进程的标记文件在 LOG_DIR/upload/worker-<id> 下,
+worker 被重启后继续上传自己没有完成的 replay
+"""
+
+import os
+import json
+import time
+import heapq
+import threading
+import itertools
+
+import jms_storage
+
+from .utils import get_logger
+
+logger = get_logger(__file__)
+PENDING_SUFFIX = '.upload'
+WORKER_PENDING_PREFIX = 'worker-'
+PRIMARY_TIMES = 3   # 配置的存储失败几次后改为上传到 jumpserver
+
+
+class UploadTask:
+    """一个待上传的 replay"""
+
+    def __init__(self, session_id, path, target, uploaded=False, times=0):
+        self.session_id = session_id
+        self.path = path            # 本地文件
+        self.target = target        # 存储中的路径
+        self.uploaded = uploaded    # 已经上传, 只需要通知 server
+        self.times = times          # 失败次数
+        self.next_time = 0
+
+    def to_json(self):
+        return {
+            "session_id": self.session_id,
+            "path": self.path,
+            "target": self.target,
+            "uploaded": self.uploaded,
+            "times": self.times,
+        }
+
+    def __str__(self):
+        return self.session_id
+
+
+class ReplayUploader:
+    """
+    replay 上传队列
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.workers = app.config['REPLAY_UPLOAD_WORKERS']
+        self.max_delay = app.config['REPLAY_UPLOAD_MAX_DELAY']
+        self.pending_dir = app.config['LOG_DIR']
+        self.workers_pending_dir = os.path.join(self.pending_dir, 'upload')
+        if app.worker_id is not None:
+            self.pending_dir = os.path.join(
+                self.workers_pending_dir,
+                WORKER_PENDING_PREFIX + str(app.worker_id))
+            os.makedirs(self.pending_dir, exist_ok=True)
+        self._tasks = []    # (next_time, counter, task) 的堆
+        self._cond = threading.Condition()
+        self.stop_evt = threading.Event()
+        self._counter = itertools.count()
+        self._client = None
+        self._jms_client = None
+
+    @property
+    def client(self):
+        """配置的存储, 只初始化一次"""
+        if self._client is None:
+            self._client = jms_storage.init(self.app.config["REPLAY_STORAGE"])
+            if not self._client:
+                self._client = self.jms_client
+        return self._client
+
+    @property
+    def jms_client(self):
+        if self._jms_client is None:
+            self._jms_client = jms_storage.jms(self.app.service)
+        return self._jms_client
+
+    def start(self, resume=True):
+        """
+        :param resume: 继续上传崩溃前没有完成的 replay
+        """
+        if resume:
+            if self.app.worker_id is None:
+                self.adopt_orphans()
+            self.load_pending()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.run,
+                                      name='replay-uploader-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+
+    def pending_path(self, session_id):
+        return os.path.join(self.pending_dir, session_id + PENDING_SUFFIX)
+
+    def save_pending(self, task):
+        with open(self.pending_path(task.session_id), 'w') as f:
+            json.dump(task.to_json(), f)
+
+    def remove_pending(self, task):
+        try:
+            os.unlink(self.pending_path(task.session_id))
+        except OSError:
+            pass
+
+    def adopt_orphans(self):
+        """
+        SSHD_WORKERS 调小后, 多出来的 worker 不会再启动,
+        把它们的标记文件移到主进程的目录, 由主进程继续上传
+        """
+        workers = self.app.config['SSHD_WORKERS']
+        workers = workers if workers > 1 else 0
+        try:
+            dirnames = os.listdir(self.workers_pending_dir)
+        except OSError:
+            return
+        for dirname in dirnames:
+            worker_id = dirname[len(WORKER_PENDING_PREFIX):]
+            if not dirname.startswith(WORKER_PENDING_PREFIX) or \
+                    not worker_id.isdigit() or int(worker_id) < workers:
+                continue
+            path = os.path.join(self.workers_pending_dir, dirname)
+            for filename in os.listdir(path):
+                if filename.endswith(PENDING_SUFFIX):
+                    os.replace(os.path.join(path, filename),
+                               os.path.join(self.pending_dir, filename))
+
+    def load_pending(self):
+        """启动时继续上传没有完成的 replay"""
+        for filename in os.listdir(self.pending_dir):
+            if not filename.endswith(PENDING_SUFFIX):
+                continue
+            try:
+                with open(os.path.join(self.pending_dir, filename)) as f:
+                    task = UploadTask(**json.load(f))
+            except (OSError, ValueError, TypeError) as e:
+                logger.error("Load pending replay {} error: {}".format(
+                    filename, e))
+                continue
+            logger.info("Resume upload session {}'s replay".format(task))
+            self.put(task)
+
+    def put(self, task):
+        with self._cond:
+            heapq.heappush(self._tasks,
+                           (task.next_time, next(self._counter), task))
+            self._cond.notify()
+
+    def get(self):
+        """
+        取出到期的任务, 最早的任务没有到期时等到它到期
+
+        :return: 停止后返回 None
+        """
+        with self._cond:
+            while not self.stop_evt.is_set():
+                if not self._tasks:
+                    self._cond.wait()
+                    continue
+                delay = self._tasks[0][0] - time.time()
+                if delay <= 0:
+                    return heapq.heappop(self._tasks)[2]
+                self._cond.wait(delay)
+        return None
+
+    def upload(self, session_id, path, target):
+        """
+        加入上传队列
+
+        :param session_id: session id
+        :param path: 本地 replay 文件
+        :param target: 存储中的路径
+        """
+        task = UploadTask(session_id, path, target)
+        self.save_pending(task)
+        self.put(task)
+
+    def run(self):
+        while True:
+            task = self.get()
+            if task is None:
+                break
+            self.handle(task)
+
+    def handle(self, task):
+        if not task.uploaded:
+            task.uploaded = self.push_to_storage(task)
+            if task.uploaded:
+                task.times = 0
+                self.save_pending(task)
+            else:
+                self.retry(task)
+                return
+
+        if self.app.service.finish_replay(task.session_id):
+            logger.info(
+                "success report session {}'s replay log ".format(task))
+            self.remove_pending(task)
+        else:
+            logger.error("failed report session {}'s replay log".format(task))
+            self.retry(task)
+
+    def push_to_storage(self, task):
+        """推送到仓库, 配置的存储多次失败后推送到 jumpserver"""
+        if task.times < PRIMARY_TIMES:
+            client = self.client
+        else:
+            client = self.jms_client
+        try:
+            ok = client.upload_file(task.path, task.target)
+        except Exception as e:
+            logger.error("Push session {}'s replay error: {}".format(task, e))
+            ok = False
+        if ok:
+            logger.info(
+                "success push session: {}'s replay log to storage ".format(task))
+        else:
+            logger.error(
+                "failed push session {}'s replay log to storage, {} times".format(
+                    task, task.times + 1))
+        return ok
+
+    def retry(self, task):
+        """指数退避后重新放回队列"""
+        task.times += 1
+        delay = min(2 ** task.times, self.max_delay)
+        task.next_time = time.time() + delay
+        self.save_pending(task)
+        self.put(task)
+
+    def shutdown(self):
+        with self._cond:
+            self.stop_evt.set()
+            self._cond.notify_all()
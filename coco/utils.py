@@ -5,9 +5,11 @@
 from __future__ import unicode_literals
 
 import hashlib
+import ipaddress
 import logging
 import re
 import os
+import socket
 import threading
 import base64
 import calendar
@@ -20,6 +22,7 @@ from binascii import hexlify
 import paramiko
 import pyte
 import pytz
+from wcwidth import wcwidth
 from email.utils import formatdate
 from queue import Queue, Empty
 
@@ -46,7 +49,7 @@ def ssh_pubkey_gen(private_key=None, username='jumpserver', hostname='localhost'
     if isinstance(private_key, str):
         private_key = ssh_key_string_to_obj(private_key)
 
-    if not isinstance(private_key, (paramiko.RSAKey, paramiko.DSSKey)):
+    if not isinstance(private_key, paramiko.PKey):
         raise IOError('Invalid private key')
 
     public_key = "%(key_type)s %(key_content)s %(username)s@%(hostname)s" % {
@@ -63,6 +66,8 @@ def ssh_key_gen(length=2048, type='rsa', password=None,
     """Generate user ssh private and public key
 
     Use paramiko RSAKey generate it.
+    ecdsa 的 length 是曲线位数 (256, 384, 521), 其他值时使用 256,
+    ed25519 忽略 length, 用 cryptography 生成 OpenSSH 格式的私钥
     :return private key str and public key str
     """
 
@@ -76,8 +81,18 @@ def ssh_key_gen(length=2048, type='rsa', password=None,
             private_key_obj = paramiko.RSAKey.generate(length)
         elif type == 'dsa':
             private_key_obj = paramiko.DSSKey.generate(length)
+        elif type == 'ecdsa':
+            if length not in (256, 384, 521):
+                length = 256
+            private_key_obj = paramiko.ECDSAKey.generate(bits=length)
+        elif type == 'ed25519':
+            private_key = ed25519_key_gen(password=password)
+            private_key_obj = paramiko.Ed25519Key(
+                file_obj=StringIO(private_key), password=password)
+            public_key = ssh_pubkey_gen(private_key_obj, username=username, hostname=hostname)
+            return private_key, public_key
         else:
-            raise IOError('SSH private key must be `rsa` or `dsa`')
+            raise IOError('SSH private key must be `rsa`, `dsa`, `ecdsa` or `ed25519`')
         private_key_obj.write_private_key(f, password=password)
         private_key = f.getvalue()
         public_key = ssh_pubkey_gen(private_key_obj, username=username, hostname=hostname)
@@ -86,19 +101,71 @@ def ssh_key_gen(length=2048, type='rsa', password=None,
         raise IOError('These is error when generate ssh key.')
 
 
+def ed25519_key_gen(password=None):
+    """生成 OpenSSH 格式的 ed25519 私钥, paramiko 不能生成 ed25519 key"""
+    try:
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import ed25519
+    except ImportError:
+        raise ValueError('Generate ed25519 key need cryptography>=3.0')
+    if not hasattr(serialization.PrivateFormat, 'OpenSSH'):
+        raise ValueError('Generate ed25519 key need cryptography>=3.0')
+
+    if password:
+        encryption = serialization.BestAvailableEncryption(password.encode())
+    else:
+        encryption = serialization.NoEncryption()
+    key = ed25519.Ed25519PrivateKey.generate()
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.OpenSSH,
+        encryption,
+    ).decode()
+
+
 class TtyIOParser(object):
     """
     tty io 封装
     """
+    ps1_pattern = re.compile(r'^\[?.*@.*\]?[\$#]\s|mysql>\s')
+
     def __init__(self, width=80, height=24):
         self.screen = pyte.Screen(width, height)
         self.stream = pyte.ByteStream()
         self.stream.attach(self.screen)
-        self.ps1_pattern = re.compile(r'^\[?.*@.*\]?[\$#]\s|mysql>\s')
 
     def clean_ps1_etc(self, command):
         return self.ps1_pattern.sub('', command)
 
+    def display(self):
+        """
+        和 screen.display 一样渲染屏幕, 但只渲染写过内容的行和格子,
+        没写过的行返回空字符串
+        """
+        screen = self.screen
+        columns = screen.columns
+        lines = []
+        for y in range(screen.lines):
+            line = screen.buffer.get(y)
+            if not line:
+                lines.append('')
+                continue
+            chars = []
+            pos = 0
+            for x in sorted(line):
+                # 宽字符后面的占位格子
+                if x < pos or x >= columns:
+                    continue
+                if x > pos:
+                    chars.append(' ' * (x - pos))
+                char = line[x].data
+                chars.append(char)
+                pos = x + 2 if wcwidth(char[0]) == 2 else x + 1
+            if pos < columns:
+                chars.append(' ' * (columns - pos))
+            lines.append(''.join(chars))
+        return lines
+
     def parse_output(self, data, sep='\n'):
         """
         Parse user command output
@@ -113,7 +180,7 @@ class TtyIOParser(object):
         for d in data:
             self.stream.feed(d)
         try:
-            for line in self.screen.display:
+            for line in self.display():
                 if line.strip():
                     output.append(line)
         except IndexError:
@@ -132,7 +199,7 @@ class TtyIOParser(object):
         command = []
         for d in data:
             self.stream.feed(d)
-        for line in self.screen.display:
+        for line in self.display():
             line = line.strip()
             if line:
                 command.append(line)
@@ -144,6 +211,38 @@ class TtyIOParser(object):
         command = self.clean_ps1_etc(command)
         return command.strip()
 
+
+class TtyStreamParser(TtyIOParser):
+    """
+    长期存在的 tty 解析器, 每个 Server 一个
+
+    数据到达时用 feed 增量写入同一个 screen, 回车时 parse_input 取出命令,
+    命令输出结束时 parse_output 取出输出, 取出后 screen 被重置.
+    每一轮最多写入 maxsize 字节, 超出的部分丢弃
+    """
+    def __init__(self, width=80, height=24, maxsize=1024):
+        super().__init__(width=width, height=height)
+        self.maxsize = maxsize
+        self.size = 0
+
+    def feed(self, data):
+        if self.maxsize and self.size >= self.maxsize:
+            return
+        self.size += len(data)
+        self.stream.feed(data)
+
+    def reset(self):
+        self.size = 0
+        self.screen.reset()
+
+    def parse_output(self, data=(), sep='\n'):
+        self.size = 0
+        return super().parse_output(data, sep=sep)
+
+    def parse_input(self, data=()):
+        self.size = 0
+        return super().parse_input(data)
+
 ######################################################################
 
 def is_obj_attr_has(obj, val, attrs=("hostname", "ip", "comment")):
@@ -249,40 +348,74 @@ def wrap_with_title(text):
     return wrap_with_color(text, color='black', background='green')
 
 
+_NUMBER_RE = re.compile(r'\d+|\D+')
+
+
 def split_string_int(s):
     """Split string or int
 
-    example: test-01-02-db => ['test-', '01', '-', '02', 'db']
+    example: test-01-02-db => ['test-', 1, '-', 2, '-db']
     """
-    string_list = []
-    index = 0
-    pre_type = None
-    word = ''
-    for i in s:
-        if index == 0:
-            pre_type = int if i.isdigit() else str
-            word = i
-        else:
-            if pre_type is int and i.isdigit() or pre_type is str and not i.isdigit():
-                word += i
-            else:
-                string_list.append(word.lower() if not word.isdigit() else int(word))
-                word = i
-                pre_type = int if i.isdigit() else str
-        index += 1
-    string_list.append(word.lower() if not word.isdigit() else int(word))
-    return string_list
+    return [int(word) if word.isdigit() else word.lower()
+            for word in _NUMBER_RE.findall(s)]
+
+
+_DIGITS_RE = re.compile(r'[0-9]+')
+
+
+def _encode_digits(match):
+    # 数字编码为 \x01 + 位数 + 数字, 位数少的在前, 位数相同时按字符比较就是按数值比较,
+    # \x01 比其他字符小, 数字排在字母前面
+    number = match.group().lstrip('0') or '0'
+    return '\x01' + chr(len(number)) + number
+
+
+def natural_sort_key(s):
+    """
+    自然排序的 key, host-2 排在 host-10 前面, 不区分大小写
+
+    编码为一个字符串, 排序时只需要比较字符串,
+    最后加上原字符串, 01 和 1 的顺序固定
+    """
+    s = str(s)
+    return _DIGITS_RE.sub(_encode_digits, s.lower()) + '\x00' + s
+
+
+def ip_sort_key(ip):
+    """
+    IP 排序的 key, IPv4 在 IPv6 前面, 都按数值排序, 不是合法 IP 的排在最后
+
+    先用 inet_pton 解析, 比 ipaddress 快很多, 带 scope 的 IPv6 再交给 ipaddress
+    """
+    ip = str(ip)
+    value = ip.strip()
+    for version, family in ((4, socket.AF_INET), (6, socket.AF_INET6)):
+        try:
+            return version, int.from_bytes(socket.inet_pton(family, value), 'big'), ''
+        except OSError:
+            pass
+    try:
+        address = ipaddress.ip_address(value)
+    except ValueError:
+        return 7, 0, ip
+    return address.version, int(address), ''
+
+
+SORT_KEYS = {
+    'hostname': natural_sort_key,
+    'ip': ip_sort_key,
+}
 
 
 def sort_assets(assets, order_by='hostname'):
     """
-    资产排序
+    资产排序, hostname 自然排序, ip 按数值排序,
+    每个资产的 key 只计算一次, 用户的资产由 AssetIndex 缓存排好的顺序
     """
-    if order_by == 'ip':
-        assets = sorted(assets, key=lambda asset: [int(d) for d in asset.ip.split('.') if d.isdigit()])
-    else:
-        assets = sorted(assets, key=lambda asset: getattr(asset, order_by))
-    return assets
+    key_func = SORT_KEYS.get(order_by)
+    if key_func is None:
+        return sorted(assets, key=lambda asset: getattr(asset, order_by))
+    return sorted(assets, key=lambda asset: key_func(getattr(asset, order_by)))
 
 
 def _gettext():
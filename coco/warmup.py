@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+登录时预先连接常用资产
+
+记录每个用户最近连接的 (asset, system_user), 用户登录、拿到资产列表后,
+在后台为最常用的几个建立已经认证的连接放入连接池,
+用户选择资产时可以直接在连接池的连接上打开 channel.
+连接记录由后台线程写入, 不阻塞连接资产.
+需要同时启用 SSH_POOL
+"""
+
+import os
+import json
+import time
+import queue
+import threading
+
+from .connection import SSHConnection
+from .utils import get_logger
+
+logger = get_logger(__file__)
+DAY = 24 * 3600
+
+
+class ConnectionHistory:
+    """
+    用户的连接记录, 每个用户一个 json 文件
+
+    :param history_dir: 记录保存的目录
+    :param size: 每个用户保留的记录数
+    """
+
+    def __init__(self, history_dir, size=20):
+        self.history_dir = history_dir
+        self.size = size
+        self.lock = threading.Lock()
+        os.makedirs(history_dir, exist_ok=True)
+
+    def path(self, user_id):
+        return os.path.join(self.history_dir, '{}.json'.format(user_id))
+
+    def load(self, user_id):
+        try:
+            with open(self.path(user_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    def record(self, user_id, asset_id, system_user_id):
+        """记录一次连接"""
+        with self.lock:
+            history = self.load(user_id)
+            for item in history:
+                if item['asset'] == asset_id and \
+                        item['system_user'] == system_user_id:
+                    item['count'] += 1
+                    item['last'] = time.time()
+                    break
+            else:
+                history.append({
+                    'asset': asset_id, 'system_user': system_user_id,
+                    'count': 1, 'last': time.time(),
+                })
+            history.sort(key=lambda i: i['last'], reverse=True)
+            with open(self.path(user_id), 'w') as f:
+                json.dump(history[:self.size], f)
+
+    def top(self, user_id, n):
+        """
+        最常用的 n 个连接, 按次数和最近一次连接的时间排序
+
+        :return: [(asset_id, system_user_id), ...]
+        """
+        now = time.time()
+        history = self.load(user_id)
+        history.sort(
+            key=lambda i: i['count'] / (1 + (now - i['last']) / DAY),
+            reverse=True,
+        )
+        return [(i['asset'], i['system_user']) for i in history[:n]]
+
+
+class ConnectionWarmer:
+    """
+    根据连接记录预先建立连接
+
+    :param app: Coco
+    :param size: 每次登录最多预先建立的连接数
+    """
+
+    def __init__(self, app, size=3, history_size=20):
+        self.app = app
+        self.size = size
+        self.history = ConnectionHistory(
+            os.path.join(app.config['LOG_DIR'], 'history'), history_size)
+        self.records = queue.Queue()
+
+    def start(self):
+        thread = threading.Thread(target=self.write_records,
+                                  name='warmup-history')
+        thread.daemon = True
+        thread.start()
+
+    def record(self, user, asset, system_user):
+        """记录一次连接, 放入队列由后台线程写入"""
+        self.records.put((user.id, asset.id, system_user.id))
+
+    def write_records(self):
+        while True:
+            user_id, asset_id, system_user_id = self.records.get()
+            try:
+                self.history.record(user_id, asset_id, system_user_id)
+            except OSError as e:
+                logger.error("Record connection history error: {}".format(e))
+
+    def warm_up(self, user, assets):
+        """
+        为用户最常用的资产建立连接
+
+        :param assets: 用户有权限的资产, 只预热仍然有权限的资产
+        """
+        assets = {asset.id: asset for asset in assets}
+        for asset_id, system_user_id in self.history.top(user.id, self.size):
+            asset = assets.get(asset_id)
+            if asset is None or asset.platform == "Windows":
+                continue
+            for system_user in asset.system_users_granted:
+                if system_user.id == system_user_id:
+                    thread = threading.Thread(
+                        target=self.connect, args=(asset, system_user))
+                    thread.daemon = True
+                    thread.start()
+                    break
+
+    def connect(self, asset, system_user):
+        logger.debug("Warm up connection to {}".format(asset.hostname))
+        try:
+            SSHConnection(self.app).warm_up(asset, system_user)
+        except Exception as e:
+            logger.error("Warm up connection to {} error: {}".format(
+                asset.hostname, e))
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+"""
+多进程 sshd
+
+主进程只负责心跳、httpd 和管理 worker 进程, 每个 worker 进程运行一个完整的
+sshd. 系统支持 SO_REUSEPORT 时每个 worker 自己绑定 SSHD_PORT, 由内核分配
+新连接; 否则主进程绑定端口, worker 共享同一个监听 socket.
+
+每个 worker 的连接数放在共享数组中, MAX_CONNECTIONS 限制的是所有 worker 的总数.
+worker 每隔 HEARTBEAT_INTERVAL 把自己的 session 列表报告给主进程,
+主进程汇总后发送心跳, 心跳返回的 kill_session 任务转交给拥有该 session 的 worker,
+clear_asset_cache 任务转交给所有 worker.
+worker 退出后主进程会重新启动它
+"""
+
+import os
+import time
+import queue
+import signal
+import socket
+import threading
+import collections
+import multiprocessing
+
+from .utils import get_logger
+
+logger = get_logger(__file__)
+RESTART_DELAY = 1   # worker 退出后多久重启
+
+# 转交给 worker 的任务, 只保留 worker 需要的字段
+Task = collections.namedtuple('Task', ['id', 'name', 'args'])
+
+
+def run_worker(root_path, config, worker_id, sock, reports, tasks, connections):
+    """worker 进程的入口"""
+    from .app import Coco
+    app = Coco(root_path)
+    app.config.update(config)
+    app.run_worker(worker_id, sock, reports, tasks, connections)
+
+
+class Worker:
+    """一个 worker 进程"""
+
+    def __init__(self, worker_id):
+        self.id = worker_id
+        self.process = None
+        self.tasks = None
+        self.sessions = []      # 最近一次报告的 session
+        self.restarts = 0
+
+    @property
+    def pid(self):
+        return self.process.pid if self.process else None
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+
+class WorkerSupervisor:
+    """
+    管理 sshd worker 进程
+
+    :param app: 主进程的 Coco
+    :param size: worker 数量
+    """
+
+    def __init__(self, app, size):
+        self.app = app
+        self.size = size
+        # spawn 出来的 worker 不继承主进程的线程和锁
+        self.ctx = multiprocessing.get_context('spawn')
+        self.reports = self.ctx.Queue()
+        self.connections = self.ctx.Array('i', size)    # 每个 worker 的连接数
+        self.workers = [Worker(i) for i in range(size)]
+        self.reuse_port = hasattr(socket, 'SO_REUSEPORT')
+        self.sock = None
+        self.stop_evt = threading.Event()
+
+    def start(self):
+        # 先生成 host key, 避免多个 worker 同时生成
+        self.app.sshd.host_keys
+        if not self.reuse_port:
+            self.sock = self.app.sshd.make_socket(
+                self.app.config['BIND_HOST'], self.app.config['SSHD_PORT'],
+                backlog=self.app.config['SSHD_BACKLOG'],
+            )
+        for worker in self.workers:
+            self.start_worker(worker)
+
+        for target in (self.collect_reports, self.watch_workers):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def start_worker(self, worker):
+        # 只传递配置项, httpd 会往 config 里放入 app 对象
+        config = {k: v for k, v in self.app.config.items() if k.isupper()}
+        worker.tasks = self.ctx.Queue()
+        worker.sessions = []
+        # 退出的 worker 的连接已经断开
+        self.connections[worker.id] = 0
+        worker.process = self.ctx.Process(
+            target=run_worker,
+            args=(self.app.root_path, config, worker.id, self.sock,
+                  self.reports, worker.tasks, self.connections),
+            name='sshd-worker-{}'.format(worker.id),
+        )
+        worker.process.start()
+        logger.info("Start sshd worker {}, pid {}".format(
+            worker.id, worker.pid))
+
+    def collect_reports(self):
+        """收集 worker 报告的 session"""
+        while not self.stop_evt.is_set():
+            try:
+                worker_id, sessions = self.reports.get(timeout=1)
+            except queue.Empty:
+                continue
+            self.workers[worker_id].sessions = sessions
+
+    def watch_workers(self):
+        """重启退出的 worker"""
+        while not self.stop_evt.wait(RESTART_DELAY):
+            for worker in self.workers:
+                if worker.is_alive() or self.stop_evt.is_set():
+                    continue
+                worker.restarts += 1
+                logger.error("Sshd worker {} exit with code {}, restart {} times".format(
+                    worker.id, worker.process.exitcode, worker.restarts))
+                self.start_worker(worker)
+
+    def get_sessions(self):
+        """所有 worker 的 session"""
+        sessions = []
+        for worker in self.workers:
+            sessions.extend(worker.sessions)
+        return sessions
+
+    def dispatch_task(self, task):
+        """
+        把 kill_session 任务交给拥有该 session 的 worker
+
+        :return: 找到 worker 返回 True
+        """
+        for worker in self.workers:
+            if any(s['id'] == task.args for s in worker.sessions):
+                worker.tasks.put(Task(task.id, task.name, task.args))
+                return True
+        return False
+
+    def broadcast_task(self, task):
+        """把任务交给所有的 worker"""
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.tasks.put(Task(task.id, task.name, task.args))
+
+    def shutdown(self):
+        self.stop_evt.set()
+        for worker in self.workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGTERM)
+        deadline = time.time() + 10
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            worker.process.join(max(deadline - time.time(), 0))
+            if worker.process.is_alive():
+                worker.process.kill()
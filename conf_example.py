@@ -23,6 +23,25 @@ class Config:
     # 监听的SSH端口号, 默认2222
     # SSHD_PORT = 2222
 
+    # sshd worker 进程数, 大于 1 时启动多个进程一起监听 SSHD_PORT,
+    # 主进程负责心跳并重启退出的 worker, 0 或 1 表示单进程.
+    # BRIDGE_ENGINE 和 PARSE_ENGINE 只在 worker 中启动, 主进程中 web terminal 的会话使用线程桥接
+    # SSHD_WORKERS = 0
+
+    # sshd 使用的 host key 类型, ['rsa', 'ecdsa', 'ed25519'], 保存在 keys/host_<type>_key,
+    # 不存在时自动生成. 增加类型后客户端可能协商到新的 host key, 没有记录过它的客户端
+    # 会提示确认新的指纹, 请提前通知用户或分发 known_hosts.
+    # 生成 ed25519 需要 cryptography>=3.0, requirements 中的版本不支持,
+    # 可以用 ssh-keygen -t ed25519 -f keys/host_ed25519_key -N '' 预先生成
+    # SSHD_HOST_KEY_TYPES = ['rsa']
+
+    # sshd listen 队列长度, 连接突增时避免丢弃 SYN
+    # SSHD_BACKLOG = 128
+
+    # 同时进行 ssh 握手的线程数和等待握手的连接数, 队列满时直接拒绝新连接
+    # SSHD_HANDSHAKE_WORKERS = 16
+    # SSHD_HANDSHAKE_QUEUE_SIZE = 256
+
     # 监听的HTTP/WS端口号，默认5000
     # HTTPD_PORT = 5000
 
@@ -48,17 +67,107 @@ class Config:
     # 资产显示排序方式, ['ip', 'hostname']
     # ASSET_LIST_SORT_BY = 'ip'
 
+    # Opt> 中按 Tab 补全 hostname 或 IP, 输入时在后面显示以输入开头的数量
+    # ASSET_COMPLETION = True
+
     # 登录是否支持密码认证
     # PASSWORD_AUTH = True
 
     # 登录是否支持秘钥认证
     # PUBLIC_KEY_AUTH = True
 
+    # 最大连接数, 超过后新的 ssh 连接直接被关闭, 多进程时是所有 worker 加起来的连接数
+    # MAX_CONNECTIONS = 500
+
     # 和Jumpserver 保持心跳时间间隔
     # HEARTBEAT_INTERVAL = 5
 
+    # 每隔多少秒把连接池、缓存、命令记录等的指标写入日志, 多进程时每个进程各自写入, 0 表示不写入
+    # METRICS_LOG_INTERVAL = 60
+
     # Admin的名字，出问题会提示给用户
     # ADMINS = ''
+
+    # Session 桥接方式, thread: 每个会话一个循环, loop: 共享的 I/O 循环
+    # BRIDGE_ENGINE = 'thread'
+
+    # BRIDGE_ENGINE 为 loop 时 I/O 循环的数量, 0 表示 CPU 核数
+    # BRIDGE_LOOP_NUM = 0
+
+    # 命令解析方式, sync: 在桥接线程中解析, thread/process: 交给解析线程池/进程池
+    # PARSE_ENGINE = 'sync'
+
+    # 解析 worker 数量, 0 表示 CPU 核数
+    # PARSE_WORKER_NUM = 0
+
+    # 每个解析 worker 的任务队列大小, 满了以后桥接线程会等待
+    # PARSE_QUEUE_SIZE = 1024
+
+    # 复用到资产的 ssh 连接, 同一个资产和系统用户的新会话、sftp
+    # 直接在已经认证的连接上打开 channel
+    # SSH_POOL = False
+    # 每个连接最多同时打开的 channel, 没有 channel 的连接空闲多少秒后关闭
+    # SSH_POOL_MAX_CHANNELS = 8
+    # SSH_POOL_IDLE_TIMEOUT = 300
+    # 连接健康检查的间隔
+    # SSH_POOL_CHECK_INTERVAL = 30
+
+    # 通过网关连接资产时, 在到网关的 ssh 连接上直接转发, 到网关的连接会被复用,
+    # 不再启动 sshpass/ssh 子进程. 每个到网关的连接最多同时转发的会话数
+    # GATEWAY_MAX_CHANNELS = 64
+
+    # 资产有多个网关时, 按连接耗时和失败率从好到坏依次尝试,
+    # 一个网关多少秒没有连上时同时尝试下一个, 使用最先连上的
+    # GATEWAY_RACE_DELAY = 0.3
+
+    # 系统用户的密码和秘钥在内存中缓存多少秒, 连接资产认证失败时失效, 0 表示不缓存
+    # SYSTEM_USER_AUTH_CACHE_TTL = 300
+    # SYSTEM_USER_AUTH_CACHE_SIZE = 1000
+
+    # 用户有权限的资产和分组在内存中缓存多少秒, ssh、sftp 和 web terminal 共用,
+    # 过期后 ASSET_CACHE_MAX_STALE 秒内先使用旧的, 同时在后台刷新,
+    # jumpserver 可以下发 clear_asset_cache 任务清除缓存, 0 表示不缓存.
+    # 启用后权限被收回的用户在缓存过期前仍然能看到这些资产,
+    # 连接资产 (包括 sftp) 时会重新验证权限
+    # ASSET_CACHE_TTL = 0
+    # ASSET_CACHE_MAX_STALE = 600
+    # ASSET_CACHE_SIZE = 1000
+
+    # 登录时根据用户的连接记录, 在后台预先连接最常用的几个资产, 需要启用 SSH_POOL
+    # 连接记录保存在 LOG_DIR/history
+    # WARMUP = False
+    # WARMUP_SIZE = 3
+    # WARMUP_HISTORY_SIZE = 20
+
+    # replay 在内存中缓冲多少字节或多少秒后由后台线程写入文件
+    # REPLAY_FLUSH_SIZE = 64 * 1024
+    # REPLAY_FLUSH_INTERVAL = 1
+
+    # replay 边写边压缩, ['gzip', 'zstd', 'lz4'], 为空时在会话结束后再压缩为 gzip
+    # zstd 和 lz4 需要安装 zstandard 或 lz4
+    # REPLAY_STREAM_COMPRESS = ''
+
+    # replay 格式, ['json', 'binary'], binary 带有时间索引可以 seek, 不压缩
+    # REPLAY_FORMAT = 'json'
+
+    # jumpserver 的播放器只能读取 .replay.gz, zstd、lz4 和 binary 的 replay 默认在上传前
+    # 转换为 .replay.gz, 本地保留原来的文件. 为 True 时直接上传原来的文件,
+    # 需要播放器支持这些格式
+    # REPLAY_UPLOAD_NATIVE = False
+
+    # 命令记录队列, ['memory', 'spill'], spill 时内存中最多保留 QUEUE_MAX_SIZE 条,
+    # 超出的写入 QUEUE_SPILL_DIR 目录, 存储恢复后按顺序补传
+    # QUEUE_ENGINE = 'memory'
+    # QUEUE_MAX_SIZE = 0
+    # QUEUE_SPILL_DIR = os.path.join(BASE_DIR, 'logs', 'queue')
+
+    # 同时上传 replay 的数量, 上传失败后按指数退避重试, 最大间隔秒数
+    # REPLAY_UPLOAD_WORKERS = 2
+    # REPLAY_UPLOAD_MAX_DELAY = 300
+
+    # 命令记录存储, TYPE 可以是 server, elasticsearch, file 中的一个或多个,
+    # 多个时用逗号分隔或使用列表, 如 "server,file",
+    # elasticsearch 使用 HOSTS, file 使用 FILE (默认 LOG_DIR/command.log)
     COMMAND_STORAGE = {
         "TYPE": "server"
     }